@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+"""
+Counts every ITSI object type on one or more servers at once and reports the counts with how long each took
+
+All the counts for a server are requested at once (--workers at a time) and with several servers they all run
+together, so this is a quick health snapshot of an environment rather than a slow type by type scan.  A type
+that can't be counted (saved_page throws a 400) is reported with its error rather than stopping the rest.
+
+--sample n also reads up to n objects of each type to estimate how big the collection is.
+
+The report is one row per server and type with the fields
+
+    server, type, count, seconds, error, avg_bytes, est_bytes, sample_seconds
+
+as JSON (the default) or CSV, on stdout or into --output.
+
+Example:
+
+./census.py --server itsi1,itsi2 -u admin [--pswd changeme] --sample 20 --format csv
+
+"""
+
+import getpass, argparse, sys, itsi, json, csv, logging, time
+
+FIELDS = ['server', 'type', 'count', 'seconds', 'error', 'avg_bytes', 'est_bytes', 'sample_seconds']
+
+"""
+Get user supplied args and setup the itsi.Config object
+"""
+
+
+def setup(argv):
+    # type: (object) -> object
+
+    p = argparse.ArgumentParser(description="Example python script for using itsi.py")
+
+    p.add_argument("census")
+
+    # these are optional arguments many have defaults
+    p.add_argument("-u", "--user", help="user with access to run rest calls against ITOA", type=str, default='admin')
+    p.add_argument("--pswd", help="password for named user, no default, should prompt the user if not provided",
+                   type=str)
+    p.add_argument("-l", "--log_level", help="python logging debug,info,warn,error", type=str, default="warn")
+    p.add_argument("-s", "--server", help="Splunk server, or a comma separated list to count them all at once",
+                   type=str, default='localhost')
+    p.add_argument("-p", "--port", help="port for REST management interface", type=int, default=8089)
+    p.add_argument("-t", "--types", help="comma separated list of types to count, defaults to all of them", type=str)
+    p.add_argument("-w", "--workers", help="counts in flight at once per server", type=int, default=8)
+    p.add_argument("--sample", help="read up to this many objects of each type to estimate its size", type=int,
+                   default=0)
+    p.add_argument("-f", "--format", help="json or csv", type=str, choices=['json', 'csv'], default='json')
+    p.add_argument("-o", "--output", help="file to write the report to, defaults to stdout", type=str)
+
+    args = p.parse_args(argv)
+    itsi.setup_logging(level=args.log_level)
+
+    if not args.pswd:
+        # getting the password because it was not supplied on the command line
+        args.pswd = getpass.getpass('\nEnter Splunk password : ')
+
+    # construct the wrapper for running commands, one per server if there are several
+    servers = args.server.split(",")
+    if len(servers) > 1:
+        cfg = itsi.MultiConfig.from_hosts(servers, user=args.user, port=args.port, pswd=args.pswd)
+    else:
+        cfg = itsi.Config(user=args.user, host=args.server, port=args.port, pswd=args.pswd)
+
+    # returning a tuple of args and the config object
+    return (args, cfg)
+
+
+def run_census(cfg, args):
+    """
+    The report rows for every server cfg points at, a server that fails altogether gets one row with its error
+    """
+    types = args.types.split(",") if args.types else None
+    if not isinstance(cfg, itsi.MultiConfig):
+        cfg = itsi.MultiConfig([cfg])
+    res = cfg.census(types=types, workers=args.workers, sample=args.sample)
+
+    rows = []
+    for server in sorted(res.seconds):
+        if server in res.errors:
+            e = res.errors[server]
+            rows.append({'server': server, 'type': None, 'count': None, 'seconds': res.seconds[server],
+                         'error': getattr(e, 'text', None) or str(e)})
+            continue
+        for t in res.results[server]:
+            t['server'] = server
+            rows.append(t)
+    return rows
+
+
+def write_report(rows, fmt, fp):
+    if fmt == 'csv':
+        w = csv.DictWriter(fp, FIELDS, extrasaction='ignore')
+        w.writeheader()
+        for r in rows:
+            w.writerow(r)
+    else:
+        fp.write(json.dumps([dict((f, r.get(f)) for f in FIELDS) for r in rows], indent=2))
+        fp.write("\n")
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger("splunk.bitsi.census")
+    args, cfg = setup(sys.argv)
+
+    start = time.time()
+    rows = run_census(cfg, args)
+    logger.info("census of %d types took %0.1f secs" % (len([r for r in rows if r["type"]]), time.time() - start))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            write_report(rows, args.format, fp)
+    else:
+        write_report(rows, args.format, sys.stdout)
+
+    if any(r['error'] for r in rows if r['type'] is None):
+        sys.exit(1)
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+"""
+Reads a CSV file listing services to create from service templates and creates them in bulk via REST
+
+Fields in the CSV are as follows:
+
+    template:   title of the template service to copy, its KPIs and entity rules are copied to the new service
+    title:      title of the new service
+    overrides:  optional JSON object of properties to set on the new service, eg {"description": "web tier"}
+
+any other column that has a value is set as a property of the same name on the new service.
+
+Each template is read once however many rows use it, then the services are created in batches using
+bulk_update on a number of workers.  At the end the number created per second is reported.
+
+Example:
+
+./create_services.py --server splunk_server -u admin [--pswd changeme] --workers 8 ./services.csv
+
+"""
+
+import getpass, argparse, sys, itsi, json, csv, logging
+
+"""
+Get user supplied args and setup the itsi.Config object
+"""
+
+
+def setup(argv):
+    # type: (object) -> object
+
+    p = argparse.ArgumentParser(description="Example python script for using itsi.py")
+
+    p.add_argument("create_services")
+
+    # these are optional arguments many have defaults
+    p.add_argument("-u", "--user", help="user with access to run rest calls against ITOA", type=str, default='admin')
+    p.add_argument("--pswd", help="password for named user, no default, should prompt the user if not provided",
+                   type=str)
+    p.add_argument("-l", "--log_level", help="python logging debug,info,warn,error", type=str, default="warn")
+    p.add_argument("-s", "--server", help="Splunk server", type=str, default='localhost')
+    p.add_argument("-p", "--port", help="port for REST management interface", type=int, default=8089)
+    p.add_argument("-b", "--batch_size", help="services created per bulk request", type=int, default=100)
+    p.add_argument("-w", "--workers", help="bulk requests sent at once", type=int, default=4)
+    p.add_argument("-y", "--dryrun", help="just list the changes and make no commits", action="store_true",
+                   default=False)
+
+    # these are positional arguments and must be supplied or it will error
+    p.add_argument("infile", help="the name of the input file")
+
+    args = p.parse_args(argv)
+    itsi.setup_logging(level=args.log_level)
+
+    if not args.pswd:
+        # getting the password because it was not supplied on the command line
+        args.pswd = getpass.getpass('\nEnter Splunk password : ')
+
+    # construct the wrapper for running commands
+    cfg = itsi.Config(user=args.user, host=args.server, port=args.port, pswd=args.pswd)
+
+    # returning a tuple of args and the config object
+    return (args, cfg)
+
+
+def read_rows(infile, errors=None):
+    """
+    Generator of (template, title, overrides) from the CSV, rows without a template or title are skipped.
+    Rows are checked as they are read, one whose overrides aren't a JSON object is logged, added to errors as
+    (line, title, problem) and skipped rather than stopping the upload part way through
+    """
+    with open(infile) as fp:
+        reader = csv.DictReader(fp)
+        for r in reader:
+            if not r.get('template') or not r.get('title'):
+                logger.info("can't process row (%s)" % str(r))
+                continue
+            try:
+                overrides = json.loads(r['overrides']) if r.get('overrides') else {}
+                if not isinstance(overrides, dict):
+                    raise ValueError("it's a %s" % type(overrides).__name__)
+            except ValueError as e:
+                problem = "overrides %s is not a JSON object: %s" % (r['overrides'], e)
+                logger.error("line %d (%s): %s" % (reader.line_num, r['title'], problem))
+                if errors is not None:
+                    errors.append((reader.line_num, r['title'], problem))
+                continue
+            for k in r:
+                if k not in ('template', 'title', 'overrides') and r[k]:
+                    overrides[k] = r[k]
+            yield r['template'], r['title'], overrides
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger("splunk.bitsi.create_services")
+    args, cfg = setup(sys.argv)
+
+    errors = []
+    if args.dryrun:
+        for tpl, title, overrides in read_rows(args.infile, errors):
+            print("would create %s from %s with %s" % (title, tpl, json.dumps(overrides)))
+        for line, title, problem in errors:
+            print("would not create %s, line %d: %s" % (title, line, problem))
+        sys.exit(1 if errors else 0)
+
+    res = cfg.create_services(read_rows(args.infile, errors), batch_size=args.batch_size, workers=args.workers)
+
+    for tpl, title, overrides in res['missing']:
+        print("not created %s, template %s not found" % (title, tpl))
+    for chunk, error in res['failed']:
+        print("failed to create %d services (%s ...): %s" % (len(chunk), chunk[0]['title'], error.text))
+    for line, title, problem in errors:
+        print("not created %s, line %d: %s" % (title, line, problem))
+    if res['error'] is not None:
+        print("stopped reading %s: %s" % (args.infile, res['error']))
+    print("created %d services in %0.1f secs, %0.1f services per sec" % (res['objects'], res['seconds'], res['per_sec']))
+    if errors or res['failed'] or res['missing'] or res['error'] is not None:
+        sys.exit(1)
@@ -8,14 +8,21 @@ The process does the following:
 2. Reads a CSV of templates to create.  Terminates if CSV is bad
 3. For each new policy from CSV
         i. copies the default policy and adds a new time based policy for each line
-        ii. loads that as a new object into the instance via REST
+        ii. loads that into the instance via REST, templates are sent in batches (--batch_size) on a number of
+            workers (--workers) and ones that haven't changed since they were last loaded are skipped.
+            To tell, a hash of each template's content is added to the end of its description, eg
+            "... [create_threshold_templates 3f2a...]", leave that in place or the template is loaded again.
+            A template of the same name that this script didn't make (it has no hash) is left alone and reported
+            as "exists (not managed)" unless --overwrite is given
 4. Every template will get a simple default policy added that is static info only so it shows gaps as blue bars
 
 To use this process I expect you will create the CSV, run the script and upload the policies, check they are good and if they don't work delete them and rerun.
 Only once they are good will they be used on services because once they hit the services you can only update via the UI not the CSV.
 Proper use of service templates though will help this process.
 
-CSV input file must be UTF-8 without BOM or the reader freaks out, fix in your fav editor, saving as excel adds the BOM.
+The input can be a CSV (UTF-8, with or without the BOM excel adds) or an .xlsx workbook, which needs openpyxl.  It is
+read a row at a time and each template is uploaded once its rows are done, so keep the rows of a template together.
+Bad rows are reported and their template is not loaded.
 
 Example: assuming python is installed run this
 
@@ -53,7 +60,13 @@ You'll also need requests module available in your python.  Note splunk has this
 
 """
 
-import getpass, argparse, sys, itsi, json, csv, copy, logging
+import getpass, argparse, sys, itsi, json, csv, logging, hashlib, re, io, codecs, itertools, datetime
+
+try:
+    # only needed to read .xlsx files
+    import openpyxl
+except ImportError:
+    openpyxl = None
 
 """
 Get user supplied args and setup the itsi.Config object
@@ -72,7 +85,8 @@ def setup(argv):
     p.add_argument("--pswd", help="password for named user, no default, should prompt the user if not provided",
                    type=str)
     p.add_argument("-l", "--log_level", help="python logging debug,info,warn,error", type=str, default="warn")
-    p.add_argument("-s", "--server", help="Splunk server", type=str, default='localhost')
+    p.add_argument("-s", "--server", help="Splunk server, or a comma separated list to load them all at once", type=str,
+                   default='localhost')
     p.add_argument("-p", "--port", help="port for REST management interface", type=int, default=8089)
     p.add_argument("-d", "--default_template",
                    help="id of the template to clone, defaults to '1-hour blocks every day (adaptive/quantile)'",
@@ -80,11 +94,16 @@ def setup(argv):
     p.add_argument("-t", "--type",
                    help="type of update, regular or custom, regular takes one line per period and replicates over days specified, custom just builds one period per line",
                    type=str, default="regular")
+    p.add_argument("--sheet", help="sheet to read from an .xlsx input file, defaults to the first one", type=str)
+    p.add_argument("-b", "--batch_size", help="templates sent per bulk request", type=int, default=20)
+    p.add_argument("-w", "--workers", help="bulk requests sent at once", type=int, default=4)
+    p.add_argument("--overwrite", help="replace templates of the same name that this script didn't make",
+                   action="store_true", default=False)
     p.add_argument("-y", "--dryrun", help="just list the changes and make no commits", action="store_true",
                    default=False)
 
     # these are positional arguments and must be supplied or it will error
-    p.add_argument("infile", help="the name of the input file")
+    p.add_argument("infile", help="the name of the input file, CSV or .xlsx")
 
     args = p.parse_args(argv)
     itsi.setup_logging(level=args.log_level)
@@ -95,8 +114,12 @@ def setup(argv):
         # getting the password because it was not supplied on the command line
         args.pswd = getpass.getpass('\nEnter Splunk password : ')
 
-    # construct the wrapper for running commands
-    cfg = itsi.Config(user=args.user, host=args.server, port=args.port, pswd=args.pswd)
+    # construct the wrapper for running commands, one per server if there are several
+    servers = args.server.split(",")
+    if len(servers) > 1:
+        cfg = itsi.MultiConfig.from_hosts(servers, user=args.user, port=args.port, pswd=args.pswd)
+    else:
+        cfg = itsi.Config(user=args.user, host=args.server, port=args.port, pswd=args.pswd)
 
     # returning a tuple of args and the config object
     return (args, cfg)
@@ -112,17 +135,37 @@ sevMap = {
 }
 
 
-def get_thresholds(cfg, entity=False):
-    type = 'E' if entity else 'A'
-    arr = []
-    n = 1
-    while True:
-        try:
-            if cfg[type + "T" + str(n)] in sevMap:
-                arr.append((n, cfg[type + "T" + str(n)], cfg[type + "V" + str(n)]))
+# day numbers in the days column to the names used in policy titles
+DAY_NAMES = {"0": "M", "1": "Tu", "2": "W", "3": "Th", "4": "F", "5": "Sa", "6": "Su"}
+
+
+def day_names(days):
+    # one pass over the days column rather than a replace per day
+    return "".join(DAY_NAMES.get(c, c) for c in str(days))
+
+
+def threshold_columns(headers):
+    """
+    Work out the threshold columns once from the CSV headers, returns {'A': [(n, 'ATn', 'AVn'), ...], 'E': [...]}
+    where n counts up from 1 for as long as there is a T column, as get_thresholds always did
+    """
+    headers = set(headers)
+    columns = {}
+    for type in ('A', 'E'):
+        columns[type] = []
+        n = 1
+        while type + "T" + str(n) in headers:
+            columns[type].append((n, type + "T" + str(n), type + "V" + str(n)))
             n = n + 1
-        except KeyError:
-            break
+    return columns
+
+
+def get_thresholds(cfg, entity=False, columns=None):
+    # columns is from threshold_columns, pass it in when building lots of rows so the headers aren't probed each time
+    type = 'E' if entity else 'A'
+    if columns is None:
+        columns = threshold_columns(cfg)
+    arr = [(n, cfg[t], cfg[v]) for n, t, v in columns[type] if cfg[t] in sevMap]
 
     baseSev = cfg['ENT_BASE'] if entity else cfg['AGG_BASE']
     res = {
@@ -162,7 +205,7 @@ def get_default_policy():
     }
 
 
-def updatePolicies(policies, policy_type):
+def updatePolicies(policies, policy_type, r, columns=None):
     """
     Make the policy title value.
     Pattern will be Start_Day[-End_Day] Start-End (method)
@@ -170,9 +213,13 @@ def updatePolicies(policies, policy_type):
     M-F 01:00-01:30 (range)
     eg for Days 0,2,3,4 Start=01:00 End=03:45 type=stdev the title will be
     M,W,Th,F 01:00-01:30 (stdev)
+
+    columns is from threshold_columns(headers), worked out from the row if it isn't passed
     """
-    days = str(r['days']).replace("0", "M").replace("1", "Tu").replace("2", "W").replace("3", "Th"). \
-        replace("4", "F").replace("5", "Sa").replace("6", "Su")
+    days = day_names(r['days'])
+    # the thresholds are the same for every time block of a row so build them once and share them
+    entity_thresholds = get_thresholds(r, entity=True, columns=columns)
+    aggregate_thresholds = get_thresholds(r, columns=columns)
 
     if policy_type == "regular":
         for i in range(0, 24):
@@ -184,8 +231,8 @@ def updatePolicies(policies, policy_type):
                 'title': title,
                 'policy_type': r['type'],
                 'time_blocks': [["0 %d * * %s" % (i, str(r['days'])), 60]],
-                'entity_thresholds': get_thresholds(r, entity=True),
-                'aggregate_thresholds': get_thresholds(r)
+                'entity_thresholds': entity_thresholds,
+                'aggregate_thresholds': aggregate_thresholds
             }
     elif policy_type == "custom":
         start = r['start']
@@ -208,17 +255,180 @@ def updatePolicies(policies, policy_type):
             'title': title,
             'policy_type': r['type'],
             'time_blocks': [[cron, duration]],
-            'entity_thresholds': get_thresholds(r, entity=True),
-            'aggregate_thresholds': get_thresholds(r)
+            'entity_thresholds': entity_thresholds,
+            'aggregate_thresholds': aggregate_thresholds
         }
     else:
         logger.error("Unknown type passed")
 
 
-if __name__ == '__main__':
-    logger = logging.getLogger("splunk.bitsi.create_threshold_templates")
-    args, cfg = setup(sys.argv)
+# a single day 0-6, a range a-b or a list a,b,c as used in the cron of the time blocks
+DAYS_RE = re.compile(r"^[0-6]([-,][0-6])*$")
+TIME_RE = re.compile(r"^\d{1,2}:\d{2}$")
+
+
+def csv_rows(infile):
+    """
+    Generator of (line number, row dict) read from a CSV a row at a time, a BOM at the start is skipped
+    """
+    if sys.version_info[0] < 3:
+        fp = open(infile, 'rb')
+    else:
+        fp = io.open(infile, encoding='utf-8-sig', newline='')
+    with fp:
+        reader = csv.reader(fp)
+        headers = next(reader, [])
+        if sys.version_info[0] < 3 and headers and headers[0].startswith(codecs.BOM_UTF8):
+            headers[0] = headers[0][len(codecs.BOM_UTF8):]
+        for r in reader:
+            yield reader.line_num, dict(zip(headers, r + [''] * (len(headers) - len(r))))
 
+
+def xlsx_rows(infile, sheet=None):
+    """
+    Generator of (row number, row dict) from the first sheet of a workbook (or the one named), read a row at a time.
+    Cells are turned into the strings the same row saved as CSV would have
+    """
+    if openpyxl is None:
+        logger.error("openpyxl is needed to read %s, install it or save the sheet as CSV" % infile)
+        sys.exit(1)
+    wb = openpyxl.load_workbook(infile, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet else wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        headers = [cell_text(c) for c in next(rows, ())]
+        for n, r in enumerate(rows, 2):
+            yield n, dict(zip(headers, [cell_text(c) for c in r] + [''] * (len(headers) - len(r))))
+    finally:
+        wb.close()
+
+
+def cell_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.time, datetime.datetime)):
+        # a start or end typed as 01:00 is a time cell, the CSV of it would say 01:00
+        return value.strftime("%H:%M")
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return value if isinstance(value, (str, type(u''))) else str(value)
+
+
+def read_rows(infile, sheet=None):
+    if infile.lower().endswith(".xlsx"):
+        return xlsx_rows(infile, sheet)
+    return csv_rows(infile)
+
+
+def validate_row(r, columns, policy_type):
+    """
+    The problems with a row that would stop its policies being built properly, an empty list if there are none
+    """
+    problems = []
+    if not DAYS_RE.match(r.get('days') or ''):
+        problems.append("days '%s' should be a day 0-6, a range a-b or a list a,b,c" % r.get('days'))
+    if not r.get('type'):
+        problems.append("type is missing")
+    for base in ('AGG_BASE', 'ENT_BASE'):
+        if r.get(base) not in sevMap:
+            problems.append("%s '%s' is not a severity" % (base, r.get(base)))
+    for type in ('A', 'E'):
+        for n, t, v in columns[type]:
+            if r[t] in sevMap:
+                try:
+                    float(r.get(v))
+                except (TypeError, ValueError):
+                    problems.append("%s '%s' is not a number" % (v, r.get(v)))
+            elif r[t]:
+                problems.append("%s '%s' is not a severity" % (t, r[t]))
+    if policy_type == "custom":
+        for f in ('start', 'end'):
+            if not TIME_RE.match(r.get(f) or ''):
+                problems.append("%s '%s' should be HH:MM" % (f, r.get(f)))
+    return problems
+
+
+def read_templates(infile, policy_type, errors=None, sheet=None):
+    """
+    Generator of (template name, {'policies': {...}}) read from a CSV or XLSX a row at a time.  Each template is
+    yielded as soon as its rows are done so the rows of a template must be together.  Rows are checked as they are
+    read, a template with a bad row is not yielded, the problems are logged and added to errors as
+    (line, template, problem)
+    """
+    def problem(line, name, text):
+        logger.error("line %d (%s): %s" % (line, name, text))
+        if errors is not None:
+            errors.append((line, name, text))
+
+    columns = None
+    name, template, bad = None, None, False
+    seen = set()
+    for line, r in read_rows(infile, sheet):
+        if columns is None:
+            columns = threshold_columns(r)
+        if r.get('disabled') == "1":
+            continue
+        if r.get('template', "") == "":
+            logger.info("can't process row (%s)" % str(r))
+            continue  # row is unusable
+
+        if r['template'] != name:
+            if template is not None and not bad:
+                yield name, template
+            name, bad = r['template'], False
+            template = {'policies': {'default_policy': get_default_policy()}}
+            if name in seen:
+                problem(line, name, "rows for a template must be together, this one has already been loaded")
+                bad = True
+            seen.add(name)
+
+        problems = validate_row(r, columns, policy_type)
+        for p in problems:
+            problem(line, name, p)
+        bad = bad or len(problems) > 0
+        if not bad:
+            updatePolicies(template['policies'], policy_type, r, columns)
+
+    if template is not None and not bad:
+        yield name, template
+
+
+# the content hash of a template goes in its description so the next upload can tell if it has changed
+HASH_MARKER = "[create_threshold_templates %s]"
+HASH_RE = re.compile(r"\[create_threshold_templates ([0-9a-f]+)\]")
+
+
+def content_hash(args, policies):
+    content = {'base': args.default_template, 'policies': policies}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def find_existing(cfg, names):
+    """
+    The templates already on the server with these identifying names, returns a dict of lower cased name to
+    (_key, hash) where hash is None if the template wasn't made by this script
+    """
+    existing = {}
+    names = list(set(names) | set(n.lower() for n in names))
+    for i in range(0, len(names), 50):
+        f = itsi.Filter.in_('identifying_name', names[i:i + 50])
+        for t in cfg.read_config('kpi_threshold_template', filter=f, fields='_key,identifying_name,description'):
+            m = HASH_RE.search(t.get('description') or '')
+            existing[t['identifying_name'].lower()] = (t['_key'], m.group(1) if m else None)
+    return existing
+
+
+def upload_templates(cfg, args, templates):
+    """
+    Create or update the templates, an iterable of (name, template) from read_templates, on the server cfg points at
+    using its copy of args.default_template as the base.
+    Templates whose content hash matches the one on the server are left alone, as are templates of the same name
+    without a hash (not made by this script) unless args.overwrite, the rest are sent with bulk updates of
+    args.batch_size templates on args.workers threads.  Prints and returns (report, ok), report is a list of
+    (template, status, _key) where status is one of created, updated, unchanged, exists (not managed) or failed
+    (with the error not the _key), for a dryrun its would be created or would be updated.  ok is False if any
+    templates failed or reading them stopped with an error, the templates after that aren't in the report
+    """
     tpl = cfg.read_config('kpi_threshold_template', key=args.default_template)
     if tpl == None:
         logger.error("KPI Template not found: %s" % args.default_template)
@@ -231,35 +441,91 @@ if __name__ == '__main__':
     tpl['identifying_name'] = "blank"
     tpl['title'] = "blank blank"
     tpl['acl']['owner'] = args.user
+    description = HASH_RE.sub('', tpl.get('description') or '').strip()
+
+    report = []
+    sent = {}
+
+    def changed_templates():
+        # templates are taken a batch at a time as they are read so uploading starts with the first ones
+        todo = iter(templates)
+        while True:
+            batch = list(itertools.islice(todo, args.batch_size))
+            if not batch:
+                return
+            existing = find_existing(cfg, [t for t, template in batch])
+            for t, template in batch:
+                h = content_hash(args, template['policies'])
+                key, old_hash = existing.get(t.lower(), (None, None))
+                if old_hash == h:
+                    report.append((t, 'unchanged', key))
+                    continue
+                if key is not None and old_hash is None and not args.overwrite:
+                    # made some other way, only replaced when asked to
+                    report.append((t, 'exists (not managed)', key))
+                    continue
+
+                # shares everything but the policies and the top level with tpl rather than a deepcopy each
+                new_tpl = itsi.clone(tpl, {
+                    'time_variate_thresholds_specification.policies': template['policies'],
+                    'identifying_name': t,
+                    'title': t,
+                    'description': (description + " " + HASH_MARKER % h).strip(),
+                    '_key': key or cfg._get_uuids()
+                })
+                sent[new_tpl['_key']] = (t, 'updated' if key else 'created')
+                yield new_tpl
+
+    failed = set()
+    if args.dryrun:
+        error = None
+        try:
+            for new_tpl in changed_templates():
+                t, status = sent[new_tpl['_key']]
+                report.append((t, 'would be ' + status, new_tpl['_key']))
+        except Exception as e:
+            error = e
+    else:
+        res = cfg.bulk_write("kpi_threshold_template", changed_templates(), partial=False, batch_size=args.batch_size,
+                             workers=args.workers)
+        # find_existing or reading the rows can raise part way, bulk_write stops there and hands it back
+        error = res['error']
+        for chunk, e in res['failed']:
+            for new_tpl in chunk:
+                failed.add(new_tpl['_key'])
+                report.append((new_tpl['title'], 'failed', e.text))
+        report.extend((t, status, key) for key, (t, status) in sent.items() if key not in failed)
+
+    for t, status, key in report:
+        print("%s %s (%s) on %s" % (status, t, key, cfg.host))
+    if error is not None:
+        print("stopped after %d templates on %s: %s" % (len(report), cfg.host, getattr(error, 'text', None) or error))
+    return report, error is None and not failed
 
-    templates = {}
-    # read the file, for each line
-    with open(args.infile) as fp:
-        reader = csv.DictReader(fp)
-        headers = reader.fieldnames
-        for r in reader:
-            if r['disabled'] == "1":
-                continue
-
-            try:
-                template = templates[r['template']]
-            except KeyError:
-                if r['template'] == "":
-                    logger.info("can't process row (%s)" % str(r))
-                    continue  # row is unusable
-                template = templates[r['template']] = {'policies': {'default_policy': get_default_policy()}}
-            updatePolicies(template['policies'], args.type)
-
-    for t in templates:
-        new_tpl = copy.deepcopy(tpl)
-        new_tpl['time_variate_thresholds_specification']['policies'] = templates[t]['policies']
-        new_tpl['identifying_name'] = t
-        new_tpl['title'] = t
-
-        #print json.dumps(new_tpl, indent=4)
-        id = cfg.create_config("kpi_threshold_template", new_tpl)
-
-        print "created " + str(id)
+
+if __name__ == '__main__':
+    logger = logging.getLogger("splunk.bitsi.create_threshold_templates")
+    args, cfg = setup(sys.argv)
+
+    errors = []
+    templates = read_templates(args.infile, args.type, errors, args.sheet)
+
+    if isinstance(cfg, itsi.MultiConfig):
+        # every server gets the same templates at the same time so they are all read first
+        res = cfg.run(upload_templates, args, list(templates))
+        for line in res.summary():
+            print(line)
+        incomplete = sorted(name for name, (report, ok) in res.results.items() if not ok)
+        for name in incomplete:
+            print("%s had failed templates or stopped early" % name)
+        ok = res.ok and not incomplete
+    else:
+        report, ok = upload_templates(cfg, args, templates)
+
+    for line, t, problem in errors:
+        print("not loaded %s, line %d: %s" % (t, line, problem))
+    if errors or not ok:
+        sys.exit(1)
 
     # id = cfg.create_config("kpi_threshold_template", tpl)
 
@@ -9,7 +9,6 @@ import getpass
 import itsi
 import logging
 import sys
-import time
 
 """
 Update entities based on groups of things
@@ -33,6 +32,8 @@ def setup(argv):
 
     p.add_argument("-y", "--dryrun", help="just list the changes and make no commits", action="store_true",
                    default=False)
+    p.add_argument("-m", "--merge", help="merge the dv_name entities into the OS host entities with the same host and "
+                                         "delete them", action="store_true", default=False)
 
 
     args2 = p.parse_args(argv)
@@ -48,150 +49,35 @@ def setup(argv):
     # returning a tuple of args and the config object
     return (args2, cfg)
 
-ENTITIES = {}
+# pages of entities fetched at once by read_config
+READ_WORKERS = 8
+# bulk updates sent at once
+WRITE_WORKERS = 4
 
-
-
-def netapp_vserver(cfg):
-    f = itsi.Filter.rex("description", "This is an SVM within a storage array")
-    arr = cfg.read_config('entity', fields="title,_key,identifier,informational", filter=f)
-
-    moveAliasFieldsToInfo(cfg, "host", "host", arr)
-    moveAliasFieldsToInfo(cfg, "vserver-name", "vserver-name", arr)
-
-def moveAliasToInfo(cfg, field):
-    f = itsi.Filter.rex("identifier.fields", "^"+field+"$")
-    entities = cfg.read_config('entity', fields="title,_key,identifier,informational", filter=f)
-    moveAliasFieldsToInfo(cfg, field, field, entities)
-
-
-def get_alias(entity, alias):
-    # get an alias value from an entity object
-    fields = entity['identifier']['fields']
-    values = entity['identifier']['values']
-
-    if alias in fields:
-        if fields.index(alias) < len(values):
-            return values[fields.index(alias)]
-    else:
-        return None
-
-
-'''
-get all info vendor_product=Linux, itsi_role=operating_system_host and dv_name doesn't exist
-for each find the alias host and search for dv_name with the same value
-merge the two entities and delete the other 
-'''
-def fix_linux_os(cfg):
-    os_hosts_filter = '{ "informational.fields": {"$regex":"^vendor_product$"}, "informational.values": {"$regex":"^operating_system_host"} }'
-    gsn_host_filter = '{ "identifier.fields": {"$regex":"^dv_name$"}, "informational.values": {"$regex":"^operating_system_host"} }'
-
-    os_hosts = cfg.read_config('entity', fields="title,_key,identifier,informational", filter=os_hosts_filter)
-    gsn_hosts = cfg.read_config('entity', fields="title,_key,identifier,informational", filter=gsn_host_filter)
-
-    logger.info("%d %d" % (len(os_hosts), len(gsn_hosts)))
-
-    hosts_to_merge = []
-    hosts_to_delete = []
-    for os_entity in os_hosts:
-        host = get_alias(os_entity, "host")
-        if host == None:
-            logger.info("no host for %s, skipped" % (os_entity['title']))
-            continue
-        for gsn_entity in gsn_hosts:
-            dv_name = get_alias(gsn_entity, "dv_name")
-            if dv_name == None:
-                logger.info("no dv_name for %s, skipped" % (gsn_entity['title']))
-                continue
-            if dv_name == host:
-                # adding a tuple (os, gsn)
-                hosts_to_merge.append((os_entity, gsn_entity))
-                logger.info("merging on %s" % (dv_name))
-
-    logger.info("found %d entities to merge" % (len(hosts_to_merge)))
-
-
-'''
-Move disk_name to an info field
-'''
-def moveAliasFieldsToInfo(cfg, field, field_to, entities):
-
-    n = 0
-    logger.info("start moving %d fields: %s from alias to info" % (len(entities), field))
-    start = time.time()
-    T_INC=10
-    t = start+T_INC
-    for e in entities:
-        # get the disk name and move it to the info fields at the start of the list
-        key = e['_key']
-        try:
-            e = ENTITIES[key]
-        except KeyError:
-            ENTITIES[key] = e
-
-        alias_names = e['identifier']['fields']
-        alias_values = e['identifier']['values']
-        info_names = e['informational']['fields']
-        info_values = e['informational']['values']
-
-
-        try:
-            idx = alias_names.index(field)
-            info_names = info_names.insert(0, field_to)
-            info_values = info_values.insert(0, alias_values[idx])
-
-
-            del alias_names[idx]
-            del alias_values[idx]
-
-            #log.info("updating %s"%(e['title']))
-            n = n+1
-            if time.time() > t:
-                logger.info("updated %d items in %0.1f" % (n, (time.time()-start)))
-                t = time.time()+T_INC
-
-        except:
-            logger.info("Skipped %s probably no key %s in %s" % (e['title'],  field, str(alias_names)))
-            continue
-
-    logger.info("finished moving %d fields: '%s' from alias to info in %0.1f secs" % (n, field, (time.time()-start)))
+OS_HOSTS_FILTER = '{ "informational.fields": {"$regex":"^vendor_product$"}, "informational.values": {"$regex":"^operating_system_host"} }'
+GSN_HOST_FILTER = '{ "identifier.fields": {"$regex":"^dv_name$"}, "informational.values": {"$regex":"^operating_system_host"} }'
 
 
 if __name__ == '__main__':
     logger = logging.getLogger("splunk.bitsi.create_threshold_templates")
 
     args, cfg = setup(sys.argv)
-    os_hosts_filter = '{ "informational.fields": {"$regex":"^vendor_product$"}, "informational.values": {"$regex":"^operating_system_host"} }'
-    os_hosts = cfg.read_config('entity', fields="title,_key,identifier,informational", filter=os_hosts_filter)
-
 
     alias_to_infos="pool_name,disk_name,fabric_name,fabric_id,dv_u_ilo_ip_address,qtree,vserver,volume_name,site,site2"
 
-    for alias in alias_to_infos.split(","):
-        moveAliasToInfo(cfg, alias)
-
-
-    fix_linux_os(cfg);
-
-    # do the updates
-    start = time.time()
-    T_INC=10
-    t = start+T_INC
-    n=0
-
-    data = []
-    for key in ENTITIES:
-        data.append(ENTITIES[key])
-        n=n+1
-        UPDATE_SZ=250
-        if len(data) == UPDATE_SZ:
-            cfg.bulk_update_config('entity', data)
-            #cfg.update_config('entity', ENTITIES[key], key)
-            logger.info("updated %d of %d items in %0.1f - %d - %s" % (n, len(ENTITIES), (time.time()-start), len(data), ENTITIES[key]['title']))
-            t = time.time()+T_INC
-            data = []
-    if len(data) > 0:
-        cfg.bulk_update_config('entity', data)
-        logger.info("Last update %d of %d items in %0.1f - %d" % (n, len(ENTITIES), (time.time() - start), len(data)))
+    # every rule is applied in one pass over one read of the entities, each changed entity is sent once with
+    # just the fields that changed
+    rules = [itsi.MoveAliasToInfo(alias) for alias in alias_to_infos.split(",")]
+    if args.merge:
+        rules.append(itsi.MergeEntities(OS_HOSTS_FILTER, "host", GSN_HOST_FILTER, "dv_name"))
 
+    res = itsi.EntityPipeline(rules).run(cfg, dryrun=args.dryrun, workers=READ_WORKERS, write_workers=WRITE_WORKERS)
 
+    if args.dryrun:
+        for line in res['diff']:
+            print(line)
+        print("would update %d of %d entities and delete %d merged ones" % (res['changed'], res['read'], len(res['merged'])))
+    else:
+        w = res['write']
+        logger.info("updated %d of %d items in %0.1f secs, %d unchanged, %d failed chunks, %d merged entities deleted" %
+                    (w['objects'], res['read'], res['seconds'], w['skipped'], len(w['failed']), res['deleted']))
@@ -18,53 +18,126 @@ easy the syntax
 this is required for a title exact match {"title":"EXACT_STR"}
 for some regex its thorny => {"title":{"$regex":"^app|bah$", "$options":"i"}}
 
+The Filter class builds these for you (Filter.title, Filter.rex, Filter.in_ ...) and takes care of the quoting and
+URL encoding, strings are still accepted everywhere a filter is.
+
 Todo: add support for 
 #. Maintenance Services Interface
 #. Backup Restore Interface
 #. Event Management Interface
 
 example to list a count of all types:
-Note: the try clause is needed as the saved_page type throws a 400 erro 
+Note: census requests all the counts at once, a type that fails (saved_page throws a 400) has its error set
 	from itsi import Config
 	r = Config()
-	res = []
-	for i in r.list_types():
-		try:
-			res.append( "Count of %s is %d" % (i, r.get_count(i)) )
-		except ItsiError as e:
-			res.append('Failed: ' + e.text)
- 
-	for i in res:
-		print i
+	for t in r.census():
+		if t['error']:
+			print('Failed: %s %s' % (t['type'], t['error']))
+		else:
+			print('Count of %s is %d' % (t['type'], t['count']))
+
+census.py does the same from the command line for one or more servers with JSON or CSV output.
 
 
 '''
 
-import requests, csv, io, sys, uuid, json, copy, logging
+import requests, csv, io, sys, uuid, json, copy, logging, time, collections, threading, re, hashlib, sqlite3, importlib, codecs, itertools, zlib
+from multiprocessing.pool import ThreadPool
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from requests.packages.urllib3.exceptions import SNIMissingWarning
-from requests.packages.urllib3.exceptions import InsecurePlatformWarning
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-requests.packages.urllib3.disable_warnings(SNIMissingWarning)
-requests.packages.urllib3.disable_warnings(InsecurePlatformWarning)
+try:
+	# newer urllib3 (python 3 only) doesn't have these
+	from requests.packages.urllib3.exceptions import SNIMissingWarning
+	from requests.packages.urllib3.exceptions import InsecurePlatformWarning
+
+	requests.packages.urllib3.disable_warnings(SNIMissingWarning)
+	requests.packages.urllib3.disable_warnings(InsecurePlatformWarning)
+except ImportError:
+	pass
 
 logging_on = False
 
+try:
+	basestring
+except NameError:
+	basestring = str
+
+try:
+	from urllib.parse import quote
+except ImportError:
+	from urllib import quote
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
 
 class Config:
 	user = 'admin'
 	pswd = 'changeme'
 	host = 'localhost'
 	port = 8089
-	templateCache = {}
+	page_size = 1000
+	cache_size = 256		# max number of templates/objects held by templateCache
+	cache_ttl = 300		# seconds before a cached template/object is read again
+	pool_connections = 10	# number of servers to keep connection pools for
+	pool_maxsize = 10		# max connections kept open to each server
+	connect_timeout = 10	# seconds to wait for a connection
+	read_timeout = 300		# seconds to wait for the server to respond, big bulk updates can be slow
+	retries = 3			# retries for failed connections and 502/503/504s, GETs and DELETEs only
+	verify = False		# verify the server certificate, or a path to a CA bundle
+	stream_writes = False	# send bulk_update_config bodies as a chunked stream rather than one big string
+	compress_requests = False	# gzip request bodies, the server has to accept Content-Encoding: gzip
+	compress_min_bytes = 1024	# don't bother compressing bodies smaller than this
+	compress_level = 6
 
 	logger = logging.getLogger("splunk.bitsi.Config")
 
-	def __init__(self, host=None, user=None, port=None, pswd=None):
+	'''
+	The connection settings default to the class attributes above, retries can also be a urllib3 Retry for full control.
+	serializer is the Serializer used for request and response bodies, the default picks the fastest one installed.
+	compress_requests gzips the bodies of creates and updates, worth it over a slow link as entity payloads shrink a lot.
+
+	example: 32 connections to a server with a self signed CA and a longer read timeout
+		cfg = Config('itsi1', pswd=pswd, pool_maxsize=32, verify='/etc/ssl/itsi_ca.pem', read_timeout=600)
+	'''
+	def __init__(self, host=None, user=None, port=None, pswd=None, pool_connections=None, pool_maxsize=None,
+				 connect_timeout=None, read_timeout=None, retries=None, verify=None, serializer=None, stream_writes=None,
+				 compress_requests=None):
 		self.session = requests.Session()
+		# ask for compressed responses, requests un-gzips them for us
+		self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+		if compress_requests is not None:
+			self.compress_requests = compress_requests
+		self.serializer = serializer or Serializer()
+		if stream_writes is not None:
+			self.stream_writes = stream_writes
+		if pool_connections is not None:
+			self.pool_connections = pool_connections
+		if pool_maxsize is not None:
+			self.pool_maxsize = pool_maxsize
+		if connect_timeout is not None:
+			self.connect_timeout = connect_timeout
+		if read_timeout is not None:
+			self.read_timeout = read_timeout
+		if retries is not None:
+			self.retries = retries
+		if verify is not None:
+			self.verify = verify
+		self._closed_pool_stats = {'requests': 0, 'connections': 0}
+		self.stats = RequestStats()
+		self.request_hooks = []
+		self._in_flight = 0
+		self._in_flight_lock = threading.Lock()
+		self._mount_adapter(self.pool_maxsize)
+		self.templateCache = ObjectCache(self.cache_size, self.cache_ttl)
+		self.responseCache = None
 
 		self.logger.info("logging_on "+str(logging_on))
 
@@ -112,9 +185,9 @@ class Config:
 	def get_count(self, type='service', filter=''):
 		params = []
 		if filter != '':
-			params.append("filter=%s" % filter)		
+			params.append(self._filter_param(filter))
 
-		return self._get_json_or_die(self.session.get(self._get_url([type, 'count'], params), verify=False))['count']
+		return self._cached_get(type, [type, 'count'], params)['count']
 	
 
 	'''
@@ -122,16 +195,68 @@ class Config:
 	Will return a list of available types to manage
 	'''
 	def list_types(self):
-		return self._get_json_or_die(self.session.get(self._get_url(['get_supported_object_types']), verify=False))
+		return self._get_json_or_die(self._request('GET', self._get_url(['get_supported_object_types'])))
+
+	'''
+	Count every type (or just types) with all the counts in flight at once on a pool of worker threads, returns a
+	list with a dict per type, in the same order as the types
+		type - the object type
+		count - the number of objects, None if it failed
+		seconds - how long the count took
+		error - why it failed (saved_page throws a 400 for one), otherwise None
+	sample > 0 also reads up to that many objects of each type to estimate its size, adding
+		avg_bytes - the average size of the objects read once serialized
+		est_bytes - avg_bytes * count
+		sample_seconds - how long the sample took
+	Counts and samples always go to the server, the response cache isn't used.
+
+	example: a quick snapshot of what's on the server
+		for t in cfg.census(sample=10):
+			print("%(type)s %(count)s %(est_bytes)s" % t)
+	'''
+	def census(self, types=None, workers=8, sample=0):
+		types = types or self.list_types()
+		self._ensure_pool_size(workers)
+
+		def count(type):
+			res = {'type': type, 'count': None, 'seconds': 0.0, 'error': None}
+			start = time.time()
+			try:
+				res['count'] = self._get_json_or_die(self._request('GET', self._get_url([type, 'count'])))['count']
+				res['seconds'] = time.time() - start
+				if sample > 0:
+					start = time.time()
+					objs = self._get_json_or_die(self._request('GET', self._get_url([type], ["skip=0", "limit=%d" % sample])))
+					res['avg_bytes'] = sum(len(self.serializer.dumps(o)) for o in objs) // len(objs) if objs else 0
+					res['est_bytes'] = res['avg_bytes'] * res['count']
+					res['sample_seconds'] = time.time() - start
+			except (ItsiError, requests.exceptions.RequestException) as e:
+				res['error'] = getattr(e, 'text', None) or str(e)
+				self.logger.warn("census of %s failed: %s", type, res['error'])
+			if res['count'] is None:
+				res['seconds'] = time.time() - start
+			return res
+
+		start = time.time()
+		pool = ThreadPool(max(1, min(workers, len(types))))
+		try:
+			res = pool.map(count, types)
+		finally:
+			pool.terminate()
+		self.logger.info("census of %d types took %0.1f secs", len(types), time.time() - start)
+		return res
 
 
 	''' -----------------------------------------------------------------
 	json[] read_config - read all the objects from the nominated server using the filter/fields provided
-			
+
 	Params:
 		limit - number of rows to return, 0 is all records and the default value
 		filter - mongodb filter to include records
 		fields - csv list of fields to return
+		page_size - rows fetched per request when reading a collection, see iter_config
+		workers - fetch this many pages at once, see iter_config_parallel
+		track - return TrackedObjects so only what is changed gets written back, see TrackedObject
 
 	examples:
 	
@@ -146,36 +271,209 @@ class Config:
 
 	return json[]	
 	'''
-	def read_config(self, type="service", key='', filter='', fields='title,_key', limit=0):
-		params = []
-		uris = [type]
-		if( len(key) > 0 ):
-			uris.append(key)
+	def read_config(self, type="service", key='', filter='', fields='title,_key', limit=0, page_size=None, workers=1,
+					track=False):
+		if len(key) > 0:
+			obj = self.templateCache.get((type, key, fields))
+			if obj is None:
+				params = []
+				if( len(fields) > 0 ):
+					params.append("fields="+fields)
+				obj = self._get_json_or_die(self._request('GET', self._get_url([type, key], params)))
+				self.templateCache.put((type, key, fields), obj)
+			return TrackedObject(obj) if track else obj
+
+		if workers > 1 and limit <= 0:
+			objs = self.iter_config_parallel(type, filter=filter, fields=fields, page_size=page_size, workers=workers)
+		else:
+			objs = self.iter_config(type, filter=filter, fields=fields, page_size=page_size, limit=limit)
+		return list(TrackedObject.wrap(objs) if track else objs)
+
+	''' -----------------------------------------------------------------
+	generator iter_config - page through all the objects of a type using skip/limit and yield them one at a time
+
+	Only one page is held in memory at once so this is the way to walk very large collections (entities mostly).
+	Pages are sorted on sort_key so that skip/limit is stable while paging, _key is always present and unique.
+
+	Params:
+		filter - mongodb filter to include records
+		fields - csv list of fields to return
+		page_size - number of rows fetched per request, defaults to Config.page_size
+		limit - stop after this many rows, 0 is all records
+		sort_key - field to order the pages by
+
+	example: count the entities that have no informational fields without loading them all
+		n = 0
+		for e in r.iter_config('entity', fields='_key,informational', page_size=5000):
+			if len(e['informational']['fields']) == 0:
+				n += 1
+	'''
+	def iter_config(self, type="service", filter='', fields='title,_key', page_size=None, limit=0, sort_key='_key'):
+		page_size = page_size or self.page_size
+		skip = 0
+		while limit <= 0 or skip < limit:
+			n = page_size if limit <= 0 else min(page_size, limit - skip)
+			page = self._read_page(type, filter, fields, skip, n, sort_key)
+			for obj in page:
+				yield obj
+			skip += len(page)
+			if len(page) < n:
+				break
+
+	''' -----------------------------------------------------------------
+	generator stream_config - read a whole collection in one request and yield the objects as they are parsed
+
+	The response is read a chunk at a time (chunk_size bytes) and the JSON array is parsed as it arrives so only
+	one chunk and the object being parsed are in memory, not the raw response, its text and all the objects.
+	Use this where the server is happy to send everything at once and memory is tight, iter_config makes many
+	smaller requests instead.
 
-		if( len(fields) > 0 ):
+	example: process a very large entity dump on a small VM
+		for e in r.stream_config('entity', fields='title,_key,identifier,informational'):
+			...
+	'''
+	def stream_config(self, type="service", filter='', fields='title,_key', chunk_size=65536):
+		params = []
+		if len(fields) > 0:
 			params.append("fields="+fields)
-		if( limit > 0 ):
-			params.append("limit=%d" % limit)
 		if filter != '':
-			params.append("filter=%s" % (filter))
+			params.append(self._filter_param(filter))
+		url = self._get_url([type], params)
+
+		start = time.time()
+		resp = self._request('GET', url, stream=True)
+		received = [0]
+		try:
+			if not resp.ok:
+				self._get_json_or_die(resp)
+			for obj in self.serializer.iter_decode_array(self._count_bytes(resp.iter_content(chunk_size), received)):
+				yield obj
+		finally:
+			resp.close()
+			self._record('GET', url, resp, time.time() - start, None, received=received[0])
+
+	''' -----------------------------------------------------------------
+	generator iter_config_parallel - same as iter_config but fetches several pages at once
 
-		return self._get_json_or_die(self.session.get(self._get_url(uris, params), verify=False))
+	get_count is used to work out how many pages there are then they are fetched on a pool of worker threads
+	that share this Config's session (and its connection pool, which is grown to fit the workers).  No more than
+	workers pages are fetched ahead of what has been read so memory stays flat like iter_config.
+	If objects were added after the count was taken the remaining pages are read serially at the end.
+
+	Params:
+		workers - number of pages in flight at once
+		ordered - True yields objects in sort_key order, False yields each page as soon as it arrives
+
+	example: read every entity using 8 connections
+		for e in r.iter_config_parallel('entity', fields='title,_key,identifier,informational', workers=8):
+			...
+	'''
+	def iter_config_parallel(self, type="service", filter='', fields='title,_key', page_size=None, workers=4,
+							 ordered=True, sort_key='_key'):
+		page_size = page_size or self.page_size
+		total = self.get_count(type, filter)
+		self._ensure_pool_size(workers)
+
+		def fetch(skip):
+			try:
+				return skip, self._read_page(type, filter, fields, skip, page_size, sort_key), None
+			except Exception as e:
+				return skip, None, e
+
+		pool = ThreadPool(workers)
+		skips = iter(range(0, total, page_size))
+		# only workers pages are fetched ahead of the caller, the same as BulkWriter.write keeps workers chunks
+		# pending, so however slowly the objects are used no more than that many pages are held
+		pending = collections.deque()
+		done = queue.Queue()
+		last, more = 0, False
+		try:
+			while True:
+				while len(pending) < workers:
+					skip = next(skips, None)
+					if skip is None:
+						break
+					pending.append(pool.apply_async(fetch, (skip,), callback=None if ordered else done.put))
+				if not pending:
+					break
+				if ordered:
+					skip, page, error = pending.popleft().get()
+				else:
+					# the first page to arrive, pending is only counting the unordered ones
+					pending.pop()
+					skip, page, error = done.get()
+				if error is not None:
+					raise error
+				for obj in page:
+					yield obj
+				if skip >= last:
+					last, more = skip, len(page) == page_size
+		finally:
+			pool.terminate()
+
+		if more:
+			skip = last + page_size
+			while True:
+				page = self._read_page(type, filter, fields, skip, page_size, sort_key)
+				for obj in page:
+					yield obj
+				skip += len(page)
+				if len(page) < page_size:
+					break
 
 	'''
 	read a template object for the service using the title provided
-	we could cache this if its too slow and return a copy of what is in the cache because the 
-	caller WILL modify the object.
+	templates are held in templateCache and a copy of what is in the cache is returned because the 
+	caller WILL modify the object.  shared=True returns the cached object itself, which must not be changed, for
+	callers that make their services from it with clone() instead
 	This works for services and kpi_base searches only, its a limit of the API.
 	'''
-	def get_template(self, uuid, type="service"):
-		uris = [type, uuid, "templatize"]
-		return self._get_json_or_die(self.session.get(self._get_url(uris), verify=False))
+	def get_template(self, uuid, type="service", shared=False):
+		tpl = self.templateCache.get((type, uuid, "templatize"), shared)
+		if tpl is None:
+			uris = [type, uuid, "templatize"]
+			tpl = self._get_json_or_die(self._request('GET', self._get_url(uris)))
+			self.templateCache.put((type, uuid, "templatize"), tpl)
+		return tpl
+
+	'''
+	Drop cached templates and objects read by key, type=None drops everything, key=None drops all of the type.
+	Writes made through this Config do this for you, call it if the objects are changed some other way.
+	'''
+	def invalidate_cache(self, type=None, key=None):
+		self.templateCache.invalidate(type, key)
+		if self.responseCache is not None:
+			self.responseCache.invalidate(type)
+
+	'''
+	Turn on the read through cache for read_config and get_count, the results are kept for ttl seconds (or until
+	the cache is full) keyed on the request URL so asking for the same type/filter/fields twice only goes to the
+	server once.  Writes made through this Config drop everything cached for the type they write to, writes made
+	any other way are only seen once the ttl expires so keep it short or call invalidate_cache.
+	max_size=0 turns it off again.
+
+	example:
+		cfg.enable_response_cache(ttl=600)
+		...
+		print(cfg.cache_stats())
+	'''
+	def enable_response_cache(self, max_size=1024, ttl=60):
+		self.responseCache = ObjectCache(max_size, ttl) if max_size > 0 else None
+
+	'''
+	returns a dict of the hit/miss stats for the template and response caches
+	'''
+	def cache_stats(self):
+		res = {'templates': self.templateCache.stats()}
+		if self.responseCache is not None:
+			res['responses'] = self.responseCache.stats()
+		return res
 
 	def get_refresh_q_size(self):
 		url = "https://%s:%d/servicesNS/nobody/SA-ITOA/storage/collections/data/itsi_refresh_queue" \
 				% (self.host, self.port)
 		try:
-			q = self._get_json_or_die(self.session.get(url, verify=False))
+			q = self._get_json_or_die(self._request('GET', url))
 			return len(q)
 		except Exception as e:
 			self.logger.error("Failed to fetch the queue: " + str(e))
@@ -190,13 +488,14 @@ class Config:
 	'''	
 	def delete_config(self, type, key='', filter=''):
 		uris = [type]
-		if key == '' and filter == '':
+		if key == '' and Filter.is_blank(filter):
 			raise ItsiError('key and filter are blank, please supply one value or all objects of this type will be deleted')
 		elif key != '':
 			uris.append(key)
-		url = self._get_url(uris, ["filter=%s" % (filter)])
+		url = self._get_url(uris, [self._filter_param(filter)])
 		self.logger.info("Delete URL = " + url)
-		return self.session.delete(url, verify=False).ok
+		self.invalidate_cache(type, key or None)
+		return self._request('DELETE', url).ok
 
 	'''
 	Provides method to update a single object (by key) or a set (by filter)
@@ -213,8 +512,8 @@ class Config:
 	'''
 	def update_config(self, type, template, key):
 		uris = [type, key]
-	
-		return self._get_json_or_die(self.session.post(self._get_url(uris, ['is_partial_data=1']), json.dumps(template), verify=False, headers={'Content-Type': 'application/json'}))
+		self.invalidate_cache(type, key)
+		return self._get_json_or_die(self._request('POST', self._get_url(uris, ['is_partial_data=1']), self.serializer.dumps(template)))
 
 	'''
 	Provides method to update a single object (by key) or a set (by filter)
@@ -228,14 +527,35 @@ class Config:
 
 	this example can update an entity but to do so without all the original properties will see attributes lost
 	doModify('entity', {'description' : 'I can update any property'}, key='df713236-ee1f-427b-af87-73828b512461')
+
+	partial=False sends whole objects, use it when the objects are new (they need a _key set) and bulk_update creates them
 	'''
 
-	def bulk_update_config(self, type, data):
+	def bulk_update_config(self, type, data, partial=True):
 		uris = [type, "bulk_update"]
+		for obj in data:
+			self.templateCache.invalidate(type, obj.get('_key') or None)
+		if self.responseCache is not None:
+			self.responseCache.invalidate(type)
+
+		if self.stream_writes and len(data) > 1:
+			body = self.serializer.iter_encode(data)
+		else:
+			body = self.serializer.dumps(data)
+		return self._get_json_or_die(self._request('POST', self._get_url(uris, ['is_partial_data=%d' % partial]), body))
 
-		return self._get_json_or_die(
-			self.session.post(self._get_url(uris, ['is_partial_data=1']), json.dumps(data), verify=False,
-							  headers={'Content-Type': 'application/json'}))
+	'''
+	Write any number of objects through bulk_update_config, see BulkWriter for the details and the options
+	that can be passed in kwargs.
+	returns the dict of stats from BulkWriter.write
+
+	example: push a large set of modified entities using 8 workers
+		res = cfg.bulk_write('entity', entities, workers=8)
+		if res['failed']:
+			...
+	'''
+	def bulk_write(self, type, objects, **kwargs):
+		return BulkWriter(self, type, **kwargs).write(objects)
 
 
 	'''
@@ -243,11 +563,13 @@ class Config:
 	template is an object that implements the getConfig() method for the type requested
 	return key UUID of new object created
 
-	json.dumps seems to be needed to force the dict to json before sending	
+	the dict has to be turned into json before sending, self.serializer does that
 	'''
 	def create_config(self, type, template):
 		# this could fail if UUIDs are not managed
-		return self._get_json_or_die(self.session.post(self._get_url([type], []), json.dumps(template), verify=False, headers={'Content-Type': 'application/json'}))
+		if self.responseCache is not None:
+			self.responseCache.invalidate(type)
+		return self._get_json_or_die(self._request('POST', self._get_url([type], []), self.serializer.dumps(template)))
 
 # 	'''
 # 	replace the alias called name with the parameter value in the passed ruleArray
@@ -285,9 +607,8 @@ class Config:
 	# 1. the service_health KPI will be removed because if it exists in the template when we create it then it gets added twice (log that bug)
 	# 2. there are no UUIDs assigned for the KPIs so add them (log that enhancement)
 
-	# would be nicer if this returned a modified copy instead, then changes would not impact the original
-	# im thinking for performance that we'll need a caching layer on the templates so we don't have to read them
-	# them from the server every time we want one because its two API calls
+	# fixed_kpis does the same without changing svc
+	# get_template hands out copies from templateCache so fixing one doesn't change the next one read
 
 	def fix_kpis(self, svc):
 		# fix the UUIDs cause there aren't any set
@@ -300,6 +621,57 @@ class Config:
 				kpis.append(kpi)
 		svc['kpis'] = kpis
 
+	'''
+	The KPIs of svc as fix_kpis would leave them, without changing svc.  Each KPI is a clone so only its _key is
+	new and the rest is shared with svc
+	'''
+	def fixed_kpis(self, svc):
+		return [clone(kpi, {'_key': self._get_uuids()}) for kpi in svc['kpis'] if kpi['type'] != "service_health"]
+
+	'''
+	Create services from service templates in bulk.
+
+	rows is an iterable of (template_title, new_title, overrides) where overrides is a dict of properties to set on
+	the new service (or None).  Each template is looked up and read once (the first time it is used), after that every
+	service is a local copy with its KPIs fixed so the only calls made are the bulk creates, see BulkWriter for the
+	options that can be passed in kwargs (batch_size, workers etc).
+	Rows that name a template that doesn't exist are skipped and listed in the result.
+
+	returns the dict of stats from BulkWriter.write plus
+		missing - list of rows skipped because the template wasn't found
+		per_sec - services created per second
+
+	example:
+		res = cfg.create_services([('tpl_demo', 'web_%03d' % i, {'description': 'web tier'}) for i in range(1000)], workers=8)
+	'''
+	def create_services(self, rows, **kwargs):
+		keys = {}
+		missing = []
+
+		def services():
+			for tpl_title, title, overrides in rows:
+				if tpl_title not in keys:
+					found = self.read_config(filter=Filter.title(tpl_title), fields='title,_key')
+					keys[tpl_title] = found[0]['_key'] if found else None
+				if keys[tpl_title] is None:
+					self.logger.error("Template Service %s not found, can't create %s", tpl_title, title)
+					missing.append((tpl_title, title, overrides))
+					continue
+				# the cached template is shared by every service made from it, each one only copies what it changes
+				tpl = self.get_template(keys[tpl_title], shared=True)
+				svc = clone(tpl, {'kpis': self.fixed_kpis(tpl)})
+				svc.update(overrides or {})
+				svc['title'] = title
+				svc['_key'] = self._get_uuids()
+				yield svc
+
+		kwargs.setdefault('batch_size', 100)
+		res = BulkWriter(self, 'service', partial=False, **kwargs).write(services())
+		res['missing'] = missing
+		res['per_sec'] = res['objects'] / res['seconds'] if res['seconds'] > 0 else 0.0
+		self.logger.info("created %d services in %0.1f secs, %0.1f per sec", res['objects'], res['seconds'], res['per_sec'])
+		return res
+
 	# --------------------------------------------------------------------------
 	# --------------------------------------------------------------------------
 	# -----------------  Private functions used in this module -----------------
@@ -308,6 +680,228 @@ class Config:
 	def _get_uuids(self):
 		return str(uuid.uuid4())
 
+	'''
+	Read one page of a collection, used by iter_config
+	'''
+	def _read_page(self, type, filter, fields, skip, limit, sort_key='_key'):
+		params = ["skip=%d" % skip, "limit=%d" % limit]
+		if sort_key:
+			params.append("sort_key=%s&sort_dir=1" % sort_key)
+		if len(fields) > 0:
+			params.append("fields="+fields)
+		if filter != '':
+			params.append(self._filter_param(filter))
+		return self._cached_get(type, [type], params)
+
+	'''
+	GET and decode a read_config page or get_count, through the responseCache when it is turned on
+	'''
+	def _cached_get(self, type, uris, params):
+		url = self._get_url(uris, params)
+		if self.responseCache is None:
+			return self._get_json_or_die(self._request('GET', url))
+		key = (type, self._normalize_url(url))
+		res = self.responseCache.get(key)
+		if res is None:
+			res = self._get_json_or_die(self._request('GET', url))
+			self.responseCache.put(key, res)
+		return res
+
+	'''
+	The url with its query parameters sorted so the same request always makes the same cache key
+	'''
+	@staticmethod
+	def _normalize_url(url):
+		path, _, query = url.partition("?")
+		return path + "?" + "&".join(sorted(p for p in query.split("&") if p))
+
+	'''
+	Make sure the session can keep at least size connections open to the server, any connections over
+	pool_maxsize are thrown away once they have been used.  Growing the pool swaps in a new adapter, so it is
+	skipped while another thread has a request in flight on the session and the pool stays the size it was.
+	'''
+	def _ensure_pool_size(self, size):
+		if self.pool_maxsize >= size:
+			return
+		with self._in_flight_lock:
+			if self._in_flight:
+				self.logger.debug("not growing the pool to %d, %d requests in flight", size, self._in_flight)
+				return
+			self._mount_adapter(size)
+
+	def _mount_adapter(self, pool_maxsize):
+		old = self.session.adapters.get("https://")
+		if isinstance(old, HTTPAdapter):
+			for k, v in self._pool_stats(old).items():
+				self._closed_pool_stats[k] += v
+		self.pool_maxsize = pool_maxsize
+		retries = self.retries
+		if not isinstance(retries, Retry):
+			retries = Retry(total=retries, backoff_factor=0.5, status_forcelist=(502, 503, 504), raise_on_status=False)
+		self.session.mount("https://", HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=pool_maxsize,
+												   max_retries=retries))
+		if old is not None:
+			old.close()
+
+	'''
+	returns a dict of bytes sent and received before (sent, received) and after (wire_sent, wire_received)
+	compression and the total saved on the wire
+	'''
+	def compression_stats(self):
+		res = {'sent': 0, 'wire_sent': 0, 'received': 0, 'wire_received': 0}
+		for s in self.stats.to_list():
+			res['sent'] += s['bytes_sent']
+			res['wire_sent'] += s['wire_bytes_sent']
+			res['received'] += s['bytes_received']
+			res['wire_received'] += s['wire_bytes_received']
+		res['saved'] = res['sent'] - res['wire_sent'] + res['received'] - res['wire_received']
+		return res
+
+	'''
+	returns a dict of connection reuse stats for this Config
+		requests - requests sent
+		connections - connections opened (each is a TCP connect and a TLS handshake)
+		reused - requests that went on a connection that was already open
+	'''
+	def connection_stats(self):
+		res = dict(self._closed_pool_stats)
+		adapter = self.session.adapters.get("https://")
+		if isinstance(adapter, HTTPAdapter):
+			for k, v in self._pool_stats(adapter).items():
+				res[k] += v
+		res['reused'] = max(0, res['requests'] - res['connections'])
+		return res
+
+	@staticmethod
+	def _pool_stats(adapter):
+		res = {'requests': 0, 'connections': 0}
+		pools = adapter.poolmanager.pools
+		for key in pools.keys():
+			pool = pools.get(key)
+			if pool is not None:
+				res['requests'] += pool.num_requests
+				res['connections'] += pool.num_connections
+		return res
+
+	'''
+	Register a function to be called after every request with a dict of
+		method, url, type, op, status, bytes_sent, bytes_received, wire_bytes_sent, wire_bytes_received, seconds
+		and error (None unless it failed), the wire_ sizes are after compression
+	use it to feed a tracer or log slow calls, it runs on the thread that made the request so keep it quick.
+	status is 0 if no response came back.
+	'''
+	def add_request_hook(self, fn):
+		self.request_hooks.append(fn)
+
+	'''
+	Every HTTP call goes through here so they all get the same timeouts and certificate checking and
+	are timed into self.stats (see RequestStats)
+	'''
+	def _request(self, method, url, data=None, stream=False):
+		sent, wire_sent = [0], [0]
+		data, headers = self._prepare_body(data, sent, wire_sent)
+		start = time.time()
+		resp, error = None, None
+		with self._in_flight_lock:
+			self._in_flight += 1
+		try:
+			resp = self.session.request(method, url, data=data, headers=headers, verify=self.verify,
+										timeout=(self.connect_timeout, self.read_timeout), stream=stream)
+			return resp
+		except Exception as e:
+			error = e
+			raise
+		finally:
+			# a streamed response is recorded by whoever reads it, once its been read
+			if not stream or error is not None:
+				self._record(method, url, resp, time.time() - start, error, sent[0], wire_sent[0])
+
+	'''
+	returns the body to send and its headers, the body is gzipped if compress_requests is on and its big enough.
+	sent and wire_sent are one item lists that get the size before and after compression, for a streamed body
+	(a generator of chunks) they are counted as it is sent.
+	'''
+	def _prepare_body(self, data, sent, wire_sent):
+		if data is None:
+			return None, None
+		headers = {'Content-Type': 'application/json'}
+		streamed = not isinstance(data, (bytes, basestring))
+		if not streamed:
+			sent[0] = len(data)
+		if self.compress_requests and (streamed or sent[0] >= self.compress_min_bytes):
+			headers['Content-Encoding'] = 'gzip'
+			if streamed:
+				data = self._gzip(self._count_bytes(data, sent))
+			else:
+				data = b''.join(self._gzip([data]))
+		elif streamed:
+			data = self._count_bytes(data, sent)
+		if streamed:
+			data = self._count_bytes(data, wire_sent)
+		else:
+			wire_sent[0] = len(data)
+		return data, headers
+
+	def _gzip(self, chunks):
+		z = zlib.compressobj(self.compress_level, zlib.DEFLATED, 31)
+		for c in chunks:
+			out = z.compress(c)
+			if out:
+				yield out
+		yield z.flush()
+
+	@staticmethod
+	def _count_bytes(chunks, sent):
+		for c in chunks:
+			sent[0] += len(c)
+			yield c
+
+	'''
+	bytes read off the socket for a response that has been read, that is before it was un-gzipped
+	'''
+	@staticmethod
+	def _wire_bytes(resp, received):
+		try:
+			n = resp.raw.tell()
+			return n if n > 0 else received
+		except Exception:
+			return received
+
+	def _record(self, method, url, resp, seconds, error, sent=0, wire_sent=0, received=None):
+		# every request is recorded once it is finished with, streamed ones after their body has been read
+		with self._in_flight_lock:
+			self._in_flight -= 1
+		type, op = RequestStats.endpoint(url)
+		if received is None:
+			received = len(resp.content) if resp is not None else 0
+		rec = {
+			'method': method,
+			'url': url,
+			'type': type,
+			'op': op,
+			'status': resp.status_code if resp is not None else 0,
+			'bytes_sent': sent,
+			'bytes_received': received,
+			'wire_bytes_sent': wire_sent,
+			'wire_bytes_received': self._wire_bytes(resp, received) if resp is not None else 0,
+			'seconds': seconds,
+			'error': error
+		}
+		self.stats.record(rec)
+		for fn in self.request_hooks:
+			try:
+				fn(rec)
+			except Exception as e:
+				self.logger.error("request hook failed: %s", str(e))
+
+	'''
+	The filter query parameter, Filter objects are URL encoded, strings are sent as they are
+	'''
+	def _filter_param(self, filter):
+		if isinstance(filter, Filter):
+			return "filter=" + filter.urlencoded()
+		return "filter=%s" % (filter)
+
 	'''
 	Get the url to run the job
 	'''
@@ -326,7 +920,7 @@ class Config:
 	def _get_json_or_die(self, resp):
 		try:
 			resp.raise_for_status()
-			return resp.json()
+			return self.serializer.loads(resp.content)
 		except requests.exceptions.RequestException as re:
 			raise ItsiError(resp.text, re)
 		except Exception as e:
@@ -350,11 +944,1490 @@ class ItsiError(Exception):
 			self.logger.error("Raised ITSI Error: " + self.text)
 
 
+class BulkWriter:
+	"""
+	Sends an iterable of objects of any size to bulk_update_config.
+
+	Objects are chunked by count (batch_size) and by serialized size (max_bytes), a single object bigger than
+	max_bytes is sent on its own.  Chunks are sent on a pool of worker threads with at most one chunk per worker
+	in flight, so the iterable is consumed as the server keeps up and never held in memory all at once.
+	A chunk that fails is retried with exponential backoff (backoff, 2*backoff, 4*backoff ...) before it is
+	given up on and reported in the failed list.
+
+	Every q_check_secs the size of the ITSI refresh queue is checked and if it is bigger than max_refresh_q
+	no new chunks are sent until it drains, set max_refresh_q to 0 to turn this off.
+
+	For a partial update objects that have a changes() method (TrackedObject, Entity) are sent as what changes()
+	returns and skipped if it returns None.  They aren't marked clean afterwards.
+	"""
+	logger = logging.getLogger("splunk.bitsi.BulkWriter")
+
+	def __init__(self, cfg, type, batch_size=250, max_bytes=1000000, workers=4, retries=3, backoff=1.0,
+				 max_refresh_q=1000, q_check_secs=10, partial=True):
+		self.cfg = cfg
+		self.type = type
+		self.partial = partial
+		self.batch_size = batch_size
+		self.max_bytes = max_bytes
+		self.workers = workers
+		self.retries = retries
+		self.backoff = backoff
+		self.max_refresh_q = max_refresh_q
+		self.q_check_secs = q_check_secs
+		self._next_q_check = 0
+
+	'''
+	Send all the objects, returns a dict of
+		objects - the number of objects sent OK
+		chunks - the number of chunks sent OK
+		retries - the number of retries needed
+		failed - list of (chunk, error) that could not be sent
+		skipped - the number of objects with nothing changed, not sent
+		error - None, or the exception raised reading objects, the chunks already started are still finished
+		seconds - time taken
+	'''
+	def write(self, objects):
+		stats = {'objects': 0, 'chunks': 0, 'retries': 0, 'failed': [], 'skipped': 0, 'error': None}
+		start = time.time()
+		t = start + 10
+		self.cfg._ensure_pool_size(self.workers)
+		pool = ThreadPool(self.workers)
+		pending = collections.deque()
+		try:
+			try:
+				for chunk in self.chunks(self._payloads(objects, stats)):
+					while len(pending) >= self.workers:
+						self._collect(pending.popleft().get(), stats)
+					self._wait_for_refresh_q()
+					pending.append(pool.apply_async(self._send, (chunk,)))
+					if time.time() > t:
+						self.logger.info("sent %d %s objects in %0.1f secs", stats['objects'], self.type, time.time() - start)
+						t = time.time() + 10
+			except Exception as e:
+				self.logger.error("stopped sending %s objects after %d were sent: %s", self.type, stats['objects'], e)
+				stats['error'] = e
+			while pending:
+				self._collect(pending.popleft().get(), stats)
+		finally:
+			pool.terminate()
+
+		stats['seconds'] = time.time() - start
+		self.logger.info("sent %d %s objects in %d chunks in %0.1f secs, %d chunks failed, %d unchanged", stats['objects'],
+						 self.type, stats['chunks'], stats['seconds'], len(stats['failed']), stats['skipped'])
+		return stats
+
+	'''
+	Generator of lists of objects, each no longer than batch_size and (unless its a single object) no bigger than
+	max_bytes once serialized
+	'''
+	def chunks(self, objects):
+		chunk, size = [], 2
+		for obj in objects:
+			n = len(self.cfg.serializer.dumps(obj)) + 1
+			if chunk and (len(chunk) >= self.batch_size or size + n > self.max_bytes):
+				yield chunk
+				chunk, size = [], 2
+			chunk.append(obj)
+			size += n
+		if chunk:
+			yield chunk
+
+	'''
+	What to send for each object, just the changes if its a partial update and the object tracks them
+	'''
+	def _payloads(self, objects, stats):
+		objects = iter(objects)
+		while True:
+			# an error reading the objects ends the input here so the chunk being built is still sent
+			try:
+				obj = next(objects)
+			except StopIteration:
+				return
+			except Exception as e:
+				self.logger.error("stopped reading %s objects: %s", self.type, e)
+				stats['error'] = e
+				return
+			if self.partial and hasattr(obj, 'changes'):
+				obj = obj.changes()
+				if obj is None:
+					stats['skipped'] += 1
+					continue
+			elif isinstance(obj, Entity):
+				obj = obj.to_json()
+			yield obj
+
+	def _send(self, chunk):
+		attempt = 0
+		while True:
+			try:
+				self.cfg.bulk_update_config(self.type, chunk, self.partial)
+				return chunk, attempt, None
+			except (ItsiError, requests.exceptions.RequestException) as e:
+				# timeouts and dropped connections aren't retried by urllib3 for a POST so they are retried here
+				if not isinstance(e, ItsiError):
+					e = ItsiError("bulk update failed: ", e)
+				if attempt >= self.retries:
+					return chunk, attempt, e
+				delay = self.backoff * (2 ** attempt)
+				self.logger.warn("chunk of %d %s objects failed, retry in %0.1f secs: %s", len(chunk), self.type, delay, e.text)
+				time.sleep(delay)
+				attempt += 1
+
+	def _collect(self, result, stats):
+		chunk, attempts, error = result
+		stats['retries'] += attempts
+		if error is None:
+			stats['objects'] += len(chunk)
+			stats['chunks'] += 1
+		else:
+			self.logger.error("gave up on a chunk of %d %s objects: %s", len(chunk), self.type, error.text)
+			stats['failed'].append((chunk, error))
+
+	def _wait_for_refresh_q(self):
+		if self.max_refresh_q <= 0 or time.time() < self._next_q_check:
+			return
+		while True:
+			q = self.cfg.get_refresh_q_size()
+			self._next_q_check = time.time() + self.q_check_secs
+			if q <= self.max_refresh_q:
+				return
+			self.logger.info("refresh queue has %d items (max %d), waiting %d secs", q, self.max_refresh_q, self.q_check_secs)
+			time.sleep(self.q_check_secs)
+
+
+class Entity(object):
+	"""
+	Compact in-memory form of an ITSI entity, use it instead of the raw REST dict when holding lots of them.
+
+	The parallel identifier/informational fields and values lists are kept as field -> value dicts so get_alias
+	and get_info are a lookup not a list.index.  Field names repeat across nearly every entity (host, vendor_product
+	...) so they are interned and each name is only held once, values aren't as most of them (IPs, serials) are
+	unique and the table would only grow.  The instance itself has no __dict__.  Anything else in the JSON
+	(description, services ...) is kept as is in extra.
+
+	Changes made through the set/del/move methods are tracked, changes() gives the minimal partial update, _key
+	plus the sections that changed, or None if there is nothing to send.  Changing the dicts directly isn't seen.
+
+	fields[n] is paired with values[n].  A field listed more than once gives its first value to get_alias/get_info,
+	the other pairs are kept (alias_pairs/info_pairs have them all) and del/pop/move take them all, values without
+	a field are kept too so to_json loses nothing.
+
+	example: move an alias to info and send just that
+		e = Entity.from_json(cfg.read_config('entity', key, fields='_key,title,identifier,informational'))
+		e.move_alias_to_info('disk_name')
+		cfg.bulk_update_config('entity', [e.changes()])
+	"""
+	__slots__ = ('key', 'title', 'aliases', 'infos', 'extra', '_rest', '_dirty')
+
+	_strings = {}
+
+	def __init__(self, key=None, title=None, aliases=None, infos=None, extra=None):
+		self.key = key
+		self.title = title
+		self.aliases = dict((Entity.intern(f), v) for f, v in (aliases or {}).items())
+		self.infos = dict((Entity.intern(f), v) for f, v in (infos or {}).items())
+		self.extra = extra or None
+		# section -> [the (field, value) pairs of repeated fields, values with no field], only if there are any
+		self._rest = None
+		self._dirty = None
+
+	'''
+	One shared copy of the field name s, it's a plain dict rather than intern() as python 2 won't intern unicode.
+	Only field names go in here, there are few of them so the table stays small
+	'''
+	@staticmethod
+	def intern(s):
+		if isinstance(s, basestring):
+			return Entity._strings.setdefault(s, s)
+		return s
+
+	@staticmethod
+	def from_json(obj):
+		e = Entity(obj.get('_key'), obj.get('title'))
+		e._read_section('identifier', obj.get('identifier'))
+		e._read_section('informational', obj.get('informational'))
+		extra = dict((k, v) for k, v in obj.items() if k not in ('_key', 'title', 'identifier', 'informational'))
+		e.extra = extra or None
+		return e
+
+	def to_json(self):
+		obj = dict(self.extra or {})
+		obj['_key'] = self.key
+		if self.title is not None:
+			obj['title'] = self.title
+		obj['identifier'] = self._section('identifier')
+		obj['informational'] = self._section('informational')
+		return obj
+
+	def get_alias(self, field, default=None):
+		return self.aliases.get(field, default)
+
+	def get_info(self, field, default=None):
+		return self.infos.get(field, default)
+
+	'''
+	All the (field, value) pairs, repeated fields included
+	'''
+	def alias_pairs(self):
+		return self._pairs('identifier')
+
+	def info_pairs(self):
+		return self._pairs('informational')
+
+	def set_alias(self, field, value):
+		if self.aliases.get(field, self) != value:
+			self.aliases[Entity.intern(field)] = value
+			self._touch('identifier')
+
+	def set_info(self, field, value):
+		if self.infos.get(field, self) != value:
+			self.infos[Entity.intern(field)] = value
+			self._touch('informational')
+
+	'''
+	Add another value for field, it's set if the entity doesn't have the field yet
+	'''
+	def add_alias(self, field, value):
+		self._add('identifier', field, value)
+
+	def add_info(self, field, value):
+		self._add('informational', field, value)
+
+	'''
+	Remove field and return all its values, an empty list if it isn't there
+	'''
+	def pop_alias(self, field):
+		return self._pop('identifier', field)
+
+	def pop_info(self, field):
+		return self._pop('informational', field)
+
+	'''
+	Remove field, returns its (first) value
+	'''
+	def del_alias(self, field):
+		values = self._pop('identifier', field)
+		return values[0] if values else None
+
+	def del_info(self, field):
+		values = self._pop('informational', field)
+		return values[0] if values else None
+
+	'''
+	Move every value of alias field to the info field field_to (the same name by default), any values the info
+	field already has are kept.  True if the entity had the alias
+	'''
+	def move_alias_to_info(self, field, field_to=None):
+		values = self._pop('identifier', field)
+		for v in values:
+			self._add('informational', field_to or field, v)
+		return len(values) > 0
+
+	def set_title(self, title):
+		if title != self.title:
+			self.title = title
+			self._touch('title')
+
+	'''
+	Set any other top level property, eg description
+	'''
+	def set(self, prop, value):
+		if self.extra is None:
+			self.extra = {}
+		if self.extra.get(prop, self) != value:
+			self.extra[prop] = value
+			self._touch(prop)
+
+	def is_dirty(self):
+		return bool(self._dirty)
+
+	def dirty_fields(self):
+		return set(self._dirty or ())
+
+	'''
+	The partial update for what has changed since it was loaded (or mark_clean was called), None if nothing has
+	'''
+	def changes(self):
+		if not self._dirty:
+			return None
+		obj = {'_key': self.key}
+		for prop in self._dirty:
+			if prop == 'title':
+				obj['title'] = self.title
+			elif prop in ('identifier', 'informational'):
+				obj[prop] = self._section(prop)
+			else:
+				obj[prop] = self.extra.get(prop)
+		return obj
+
+	'''
+	Call once the changes have been written
+	'''
+	def mark_clean(self):
+		self._dirty = None
+
+	def __repr__(self):
+		return "Entity(%r, %r)" % (self.key, self.title)
+
+	def _touch(self, prop):
+		if self._dirty is None:
+			self._dirty = set()
+		self._dirty.add(prop)
+
+	def _dict(self, prop):
+		return self.aliases if prop == 'identifier' else self.infos
+
+	def _rest_of(self, prop, create=False):
+		rest = self._rest.get(prop) if self._rest else None
+		if rest is None and create:
+			if self._rest is None:
+				self._rest = {}
+			rest = self._rest[prop] = [[], ()]
+		return rest
+
+	def _read_section(self, prop, section):
+		if not section:
+			return
+		d = self._dict(prop)
+		fields = section.get('fields') or []
+		values = section.get('values') or []
+		repeated = []
+		for f, v in zip(fields, values):
+			f = Entity.intern(f)
+			if f in d:
+				repeated.append((f, v))
+			else:
+				d[f] = v
+		tail = tuple(values[len(fields):])
+		if repeated or tail:
+			self._rest_of(prop, True)[:] = [repeated, tail]
+
+	def _pairs(self, prop):
+		pairs = list(self._dict(prop).items())
+		rest = self._rest_of(prop)
+		if rest:
+			pairs.extend(rest[0])
+		return pairs
+
+	def _add(self, prop, field, value):
+		d = self._dict(prop)
+		field = Entity.intern(field)
+		if field in d:
+			self._rest_of(prop, True)[0].append((field, value))
+		else:
+			d[field] = value
+		self._touch(prop)
+
+	def _pop(self, prop, field):
+		d = self._dict(prop)
+		if field not in d:
+			return []
+		values = [d.pop(field)]
+		rest = self._rest_of(prop)
+		if rest and rest[0]:
+			values.extend(v for f, v in rest[0] if f == field)
+			rest[0] = [p for p in rest[0] if p[0] != field]
+		self._touch(prop)
+		return values
+
+	def _section(self, prop):
+		pairs = self._pairs(prop)
+		values = [v for f, v in pairs]
+		rest = self._rest_of(prop)
+		if rest and rest[1]:
+			values.extend(rest[1])
+		return {'fields': [f for f, v in pairs], 'values': values}
+
+
+class TrackedObject(dict):
+	"""
+	A dict read from ITSI that remembers what it looked like so only what has been changed is written back.
+
+	A hash of each top level property is kept when it is loaded (not a copy, so it costs little memory), changes()
+	compares them with the current values and returns _key plus the properties that are different or new, or
+	None if nothing is.  Nested edits are seen as a change of the top level property they are in, so changing
+	identifier.values sends identifier.  Removing a property can't be done with a partial update so it's not
+	reported, send the whole object for that.
+
+	Config.read_config(..., track=True) returns these and BulkWriter sends changes() of anything that has it.
+
+	example:
+		for e in cfg.read_config('entity', fields='_key,title,identifier,informational', track=True):
+			...change some of them in place...
+		cfg.bulk_write('entity', entities)	# just the changed ones, just the changed fields
+	"""
+
+	def __init__(self, obj=(), **kwargs):
+		dict.__init__(self, obj, **kwargs)
+		self.mark_clean()
+
+	'''
+	Wrap each object read from ITSI, for generators of them
+	'''
+	@staticmethod
+	def wrap(objects):
+		for obj in objects:
+			yield TrackedObject(obj)
+
+	def dirty_fields(self):
+		return set(k for k, v in self.items() if self._hashes.get(k) != self._hash(v))
+
+	def is_dirty(self):
+		return any(self._hashes.get(k) != self._hash(v) for k, v in self.items())
+
+	def changes(self):
+		dirty = self.dirty_fields()
+		if not dirty:
+			return None
+		obj = dict((k, self[k]) for k in dirty)
+		obj['_key'] = self.get('_key')
+		return obj
+
+	'''
+	Call once the changes have been written
+	'''
+	def mark_clean(self):
+		self._hashes = dict((k, self._hash(v)) for k, v in self.items())
+
+	@staticmethod
+	def _hash(value):
+		return hashlib.md5(json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')).digest()
+
+
+class EntityStore:
+	"""
+	Holds a set of entities in memory with hash indexes on their alias (identifier) and info (informational)
+	field/value pairs so lookups like "all entities where alias host == X" don't need to scan the lot.
+
+	fields[n] is paired with values[n] the same way entity_cleanup.get_alias does it.  If an entity is changed in
+	place call reindex(entity) so the indexes match it again, the pairs it was indexed on are kept so this is cheap.
+	The entities can be the REST dicts or Entity objects.
+
+	example: match OS hosts to dv_name hosts
+		os_hosts = EntityStore.load(cfg, os_hosts_filter)
+		gsn_hosts = EntityStore.load(cfg, gsn_host_filter)
+		for os_entity, gsn_entity in os_hosts.join(gsn_hosts, "host", "dv_name"):
+			...
+	"""
+	logger = logging.getLogger("splunk.bitsi.EntityStore")
+
+	def __init__(self, entities=()):
+		self.entities = {}
+		self._indexed = {}
+		self._alias = collections.defaultdict(set)
+		self._info = collections.defaultdict(set)
+		for e in entities:
+			self.add(e)
+
+	'''
+	Read the entities matching filter (all by default) into a new store, fields must include _key, identifier
+	and informational.  compact=True keeps them as Entity objects which take a fraction of the memory, track=True
+	as TrackedObjects, either way bulk_write only sends what has been changed
+	'''
+	@staticmethod
+	def load(cfg, filter='', fields='title,_key,identifier,informational', workers=1, compact=False, track=False):
+		if workers > 1:
+			entities = cfg.iter_config_parallel('entity', filter=filter, fields=fields, workers=workers)
+		else:
+			entities = cfg.iter_config('entity', filter=filter, fields=fields)
+		if compact:
+			entities = (Entity.from_json(e) for e in entities)
+		elif track:
+			entities = TrackedObject.wrap(entities)
+		store = EntityStore(entities)
+		EntityStore.logger.info("loaded %d entities", len(store))
+		return store
+
+	def __len__(self):
+		return len(self.entities)
+
+	def __iter__(self):
+		return iter(list(self.entities.values()))
+
+	def __contains__(self, key):
+		return key in self.entities
+
+	def get(self, key):
+		return self.entities.get(key)
+
+	def add(self, entity):
+		key = entity.key if isinstance(entity, Entity) else entity['_key']
+		self._unindex(key)
+		self.entities[key] = entity
+		aliases = self._pairs(entity, 'identifier')
+		infos = self._pairs(entity, 'informational')
+		self._indexed[key] = (aliases, infos)
+		for pair in aliases:
+			self._alias[pair].add(key)
+		for pair in infos:
+			self._info[pair].add(key)
+
+	def remove(self, key):
+		self._unindex(key)
+		return self.entities.pop(key, None)
+
+	'''
+	re-read the alias/info pairs of an entity that has been changed in place
+	'''
+	def reindex(self, entity):
+		self.add(entity)
+
+	def find_by_alias(self, field, value):
+		return [self.entities[k] for k in self._alias.get((field, value), ())]
+
+	def find_by_info(self, field, value):
+		return [self.entities[k] for k in self._info.get((field, value), ())]
+
+	'''
+	The entities that match a mongo filter, the same filter string that would be passed to read_config, see LocalFilter
+	'''
+	def query(self, filter):
+		return list(LocalFilter.compile(filter).select(self.entities.values()))
+
+	'''
+	Generator of (entity, other_entity) for every pair where the alias field of the entity in this store has the
+	same value as the alias other_field of an entity in other
+	'''
+	def join(self, other, field, other_field):
+		for (f, value), keys in list(self._alias.items()):
+			if f != field:
+				continue
+			matches = other.find_by_alias(other_field, value)
+			for k in keys:
+				for o in matches:
+					yield self.entities[k], o
+
+	def _unindex(self, key):
+		aliases, infos = self._indexed.pop(key, ((), ()))
+		for index, pairs in ((self._alias, aliases), (self._info, infos)):
+			for pair in pairs:
+				keys = index.get(pair)
+				if keys is not None:
+					keys.discard(key)
+					if not keys:
+						del index[pair]
+
+	@staticmethod
+	def _pairs(entity, section):
+		if isinstance(entity, Entity):
+			return tuple(entity.alias_pairs() if section == 'identifier' else entity.info_pairs())
+		s = entity.get(section) or {}
+		return tuple(zip(s.get('fields', []), s.get('values', [])))
+
+
+class MoveAliasToInfo:
+	"""
+	EntityPipeline rule: move the alias field to the info field field_to (the same name by default)
+	"""
+
+	def __init__(self, field, field_to=None):
+		self.field = field
+		self.field_to = field_to or field
+		self.filter = Filter.in_('identifier.fields', [field])
+
+	def apply(self, entity):
+		return entity.move_alias_to_info(self.field, self.field_to)
+
+	def __repr__(self):
+		return "MoveAliasToInfo(%s -> %s)" % (self.field, self.field_to)
+
+
+class RenameField:
+	"""
+	EntityPipeline rule: rename an alias (section identifier) or info (section informational) field
+	"""
+
+	def __init__(self, field, field_to, section='identifier'):
+		if section not in ('identifier', 'informational'):
+			raise ItsiError("section must be identifier or informational, not %s" % section)
+		self.field = field
+		self.field_to = field_to
+		self.section = section
+		self.filter = Filter.in_(section + '.fields', [field])
+
+	def apply(self, entity):
+		if self.section == 'identifier':
+			values = entity.pop_alias(self.field)
+			for v in values:
+				entity.add_alias(self.field_to, v)
+		else:
+			values = entity.pop_info(self.field)
+			for v in values:
+				entity.add_info(self.field_to, v)
+		return len(values) > 0
+
+	def __repr__(self):
+		return "RenameField(%s %s -> %s)" % (self.section, self.field, self.field_to)
+
+
+class MergeEntities:
+	"""
+	EntityPipeline rule: an entity matching other_match whose alias other_field has the same value as the alias
+	field of an entity matching match is merged into that entity and deleted.  Merging adds the aliases and info
+	fields the entity doesn't already have.
+
+	example: the OS host entities and the dv_name entities for the same host
+		MergeEntities(os_hosts_filter, "host", gsn_host_filter, "dv_name")
+	"""
+
+	def __init__(self, match, field, other_match, other_field):
+		self.field = field
+		self.other_field = other_field
+		self.filter = Filter.or_(match, other_match)
+		self._match = LocalFilter.compile(match)
+		self._other_match = LocalFilter.compile(other_match)
+		self._entities = {}
+		self._others = collections.defaultdict(list)
+		self._keys = (set(), set())
+
+	'''
+	Only the first copy of an entity is kept, a paged read can return the same one twice
+	'''
+	def apply(self, entity):
+		wanted = False
+		value = entity.get_alias(self.field)
+		if value is not None and self._match.match(entity):
+			if entity.key not in self._keys[0]:
+				self._keys[0].add(entity.key)
+				self._entities.setdefault(value, []).append(entity)
+			wanted = True
+		value = entity.get_alias(self.other_field)
+		if value is not None and self._other_match.match(entity):
+			if entity.key not in self._keys[1]:
+				self._keys[1].add(entity.key)
+				self._others[value].append(entity)
+			wanted = True
+		return wanted
+
+	'''
+	(entity, other) pairs once everything has been read, other is merged into entity
+	'''
+	def merges(self):
+		for value, entities in self._entities.items():
+			for other in self._others.get(value, ()):
+				for entity in entities:
+					yield entity, other
+		self._entities, self._others = {}, collections.defaultdict(list)
+		self._keys = (set(), set())
+
+	def __repr__(self):
+		return "MergeEntities(%s -> %s)" % (self.other_field, self.field)
+
+
+class EntityPipeline:
+	"""
+	Applies a list of rules to the entities in one pass over one streamed read, instead of a read and a loop for
+	each transformation, then writes the result back.
+
+	Every entity that any rule could touch is read once (the rules' filters are or'ed together) as a compact
+	Entity, each rule is applied to it in order and it is only kept in memory if it changed or a rule wants it
+	later.  Rules that pair entities up (MergeEntities) are resolved once everything has been read.  Each changed
+	entity becomes one partial update with just its changed fields however many rules touched it, merged
+	entities are deleted after the updates have gone without errors.
+
+	A rule has a filter (a Filter for the entities it could change, None for all of them) and apply(entity) that
+	changes the entity and returns True if it needs to be kept.  If it also has merges() that is called at the
+	end and yields (entity, other) pairs.
+
+	dryrun does everything but the writes, the diff in the result lists every change either way.
+
+	example: move two aliases to info and merge the OS hosts into the dv_name hosts
+		res = EntityPipeline([MoveAliasToInfo('disk_name'), MoveAliasToInfo('site'),
+							  MergeEntities(os_hosts_filter, 'host', gsn_host_filter, 'dv_name')]).run(cfg, dryrun=True)
+		for line in res['diff']:
+			print(line)
+	"""
+	logger = logging.getLogger("splunk.bitsi.EntityPipeline")
+
+	def __init__(self, rules):
+		self.rules = list(rules)
+
+	def filter(self):
+		filters = [r.filter for r in self.rules]
+		if not filters or any(f is None for f in filters):
+			return ''
+		return Filter.or_(*filters)
+
+	'''
+	Read, transform and write, returns a dict of
+		read - the number of entities read
+		changed - the number of entities updated (or that would be)
+		merged - list of (entity key, key it was merged into)
+		diff - lines describing every change
+		write - the bulk_write stats, None for a dryrun
+		deleted - the number of merged entities deleted
+		seconds - time taken
+	workers > 1 reads pages in parallel rather than one streamed request, write_workers is passed to bulk_write
+	'''
+	def run(self, cfg, dryrun=False, workers=1, write_workers=4, fields='title,_key,identifier,informational'):
+		start = time.time()
+		if workers > 1:
+			objs = cfg.iter_config_parallel('entity', filter=self.filter(), fields=fields, workers=workers)
+		else:
+			objs = cfg.stream_config('entity', filter=self.filter(), fields=fields)
+		res = self.apply(Entity.from_json(o) for o in objs)
+		res['write'], res['deleted'] = None, 0
+
+		if not dryrun:
+			res['write'] = cfg.bulk_write('entity', res.pop('entities'), workers=write_workers)
+			if res['write']['failed']:
+				self.logger.error("not deleting %d merged entities, %d update chunks failed", len(res['merged']),
+								  len(res['write']['failed']))
+			else:
+				res['deleted'] = self._delete(cfg, [k for k, into in res['merged']])
+		res.pop('entities', None)
+		res['seconds'] = time.time() - start
+		self.logger.info("read %d entities, %d changed, %d merged in %0.1f secs", res['read'], res['changed'],
+						 len(res['merged']), res['seconds'])
+		return res
+
+	'''
+	Apply the rules to an iterable of Entity objects, the same dict as run plus entities, the changed ones
+	'''
+	def apply(self, entities):
+		kept = collections.OrderedDict()
+		n = 0
+		for e in entities:
+			n += 1
+			before = (e.title, e.alias_pairs(), e.info_pairs())
+			wanted = False
+			for rule in self.rules:
+				wanted = rule.apply(e) or wanted
+			# a key read twice (the collection changed under a paged read) keeps the first snapshot
+			if (wanted or e.is_dirty()) and e.key not in kept:
+				kept[e.key] = (e, before)
+
+		merged, deleted = [], set()
+		for rule in self.rules:
+			if hasattr(rule, 'merges'):
+				for e, other in rule.merges():
+					if e.key == other.key or e.key in deleted or other.key in deleted:
+						continue
+					self._merge(e, other)
+					deleted.add(other.key)
+					merged.append((other.key, e.key))
+
+		changed = [e for e, before in kept.values() if e.is_dirty() and e.key not in deleted]
+		diff = []
+		for e in changed:
+			diff.extend(self._diff(e, kept[e.key][1]))
+		for key, into in merged:
+			diff.append("- %s (%s) merged into %s (%s)" % (kept[key][0].title, key, kept[into][0].title, into))
+		return {'read': n, 'changed': len(changed), 'merged': merged, 'diff': diff, 'entities': changed}
+
+	@staticmethod
+	def _merge(entity, other):
+		# every value of the fields entity doesn't have, repeated ones included
+		new_aliases = set(f for f, v in other.alias_pairs() if f not in entity.aliases)
+		new_infos = set(f for f, v in other.info_pairs() if f not in entity.infos)
+		for f, v in other.alias_pairs():
+			if f in new_aliases:
+				entity.add_alias(f, v)
+		for f, v in other.info_pairs():
+			if f in new_infos:
+				entity.add_info(f, v)
+
+	@staticmethod
+	def _diff(entity, before):
+		title, aliases, infos = before
+		lines = ["~ %s (%s)" % (entity.title, entity.key)]
+		if title != entity.title:
+			lines.append("    title %s -> %s" % (title, entity.title))
+		for name, old, new in (('alias', aliases, entity.alias_pairs()), ('info', infos, entity.info_pairs())):
+			for f, v in old:
+				if (f, v) not in new:
+					lines.append("    %s -%s=%s" % (name, f, v))
+			for f, v in new:
+				if (f, v) not in old:
+					lines.append("    %s +%s=%s" % (name, f, v))
+		return lines
+
+	def _delete(self, cfg, keys, chunk=100):
+		n = 0
+		for i in range(0, len(keys), chunk):
+			if cfg.delete_config('entity', filter=Filter.in_('_key', keys[i:i + chunk])):
+				n += len(keys[i:i + chunk])
+			else:
+				self.logger.error("failed to delete merged entities %s", ",".join(keys[i:i + chunk]))
+		return n
+
+
+class LocalFilter:
+	"""
+	Evaluates a mongo filter against objects that are already in memory so one bulk read can answer lots of queries.
+
+	Supports what this module builds and the scripts use:
+		exact match			{"title": "EXACT_STR"}
+		regex				{"title": {"$regex": "^app|bah$", "$options": "i"}}
+		in					{"title": {"$in": ["one", "two"]}}
+		dotted paths		{"identifier.fields": {"$regex": "^host$"}}
+		and/or				{"$or": [{...}, {...}]}, several fields in one filter are and'ed
+	Like mongo a path that goes through a list matches if any item in the list matches.
+	Anything else raises ItsiError rather than quietly matching the wrong things.
+
+	Filters are compiled once (regexes included) and kept, so use compile rather than the constructor.
+
+	example:
+		f = LocalFilter.compile('{"identifier.fields": {"$regex": "^host$"}}')
+		hosts = [e for e in entities if f.match(e)]
+	"""
+	_compiled = {}
+	_lock = threading.Lock()
+
+	_flags = {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL, 'x': re.VERBOSE}
+
+	def __init__(self, filter):
+		if isinstance(filter, Filter):
+			spec = filter.spec
+		else:
+			spec = json.loads(filter) if isinstance(filter, basestring) else filter
+		self.filter = filter
+		self._test = self._compile(spec or {})
+
+	@staticmethod
+	def compile(filter):
+		key = filter if isinstance(filter, (basestring, Filter)) else str(Filter(filter))
+		with LocalFilter._lock:
+			f = LocalFilter._compiled.get(key)
+			if f is None:
+				f = LocalFilter._compiled[key] = LocalFilter(filter)
+		return f
+
+	def match(self, obj):
+		return self._test(obj)
+
+	def select(self, objects):
+		for obj in objects:
+			if self._test(obj):
+				yield obj
+
+	def _compile(self, spec):
+		tests = []
+		for prop, cond in spec.items():
+			if prop in ('$and', '$or'):
+				subs = [self._compile(s) for s in cond]
+				if prop == '$and':
+					tests.append(lambda obj, subs=subs: all(t(obj) for t in subs))
+				else:
+					tests.append(lambda obj, subs=subs: any(t(obj) for t in subs))
+			elif prop.startswith('$'):
+				raise ItsiError("unsupported filter operator %s" % prop)
+			else:
+				tests.append(self._compile_field(prop.split('.'), cond))
+		return lambda obj: all(t(obj) for t in tests)
+
+	def _compile_field(self, path, cond):
+		if isinstance(cond, dict) and any(k.startswith('$') for k in cond):
+			ops = dict(cond)
+			tests = []
+			if '$regex' in ops:
+				flags = 0
+				for c in ops.pop('$options', ''):
+					flags |= self._flags.get(c, 0)
+				rex = re.compile(ops.pop('$regex'), flags)
+				tests.append(lambda v: isinstance(v, basestring) and rex.search(v) is not None)
+			if '$in' in ops:
+				vals = ops.pop('$in')
+				tests.append(lambda v: v in vals)
+			if '$eq' in ops:
+				val = ops.pop('$eq')
+				tests.append(lambda v: v == val)
+			if ops:
+				raise ItsiError("unsupported filter operator(s) %s" % ", ".join(ops))
+		else:
+			tests = [lambda v: v == cond]
+		return lambda obj: any(all(t(v) for t in tests) for v in self._values(obj, path))
+
+	'''
+	all the values found at path in obj, lists along the way are walked and the items of a list at the end of
+	the path are returned as well as the list itself, that is how mongo matches arrays
+	'''
+	@staticmethod
+	def _values(obj, path):
+		if isinstance(obj, Entity):
+			obj = obj.to_json()
+		vals = [obj]
+		for p in path:
+			next_vals = []
+			for v in vals:
+				if isinstance(v, dict):
+					if p in v:
+						next_vals.append(v[p])
+				elif isinstance(v, list):
+					next_vals.extend(i[p] for i in v if isinstance(i, dict) and p in i)
+			vals = next_vals
+		res = []
+		for v in vals:
+			if isinstance(v, list):
+				res.extend(v)
+			res.append(v)
+		return res
+
+
+# touched are objects that were saved (their mod_time moved) but whose content is the same
+SyncResult = collections.namedtuple('SyncResult', 'added changed deleted touched')
+
+
+class SyncStore:
+	"""
+	Keeps a snapshot of ITSI objects (key, mod_time and a hash of the content) in a local SQLite file so a job can
+	work on just what has changed since it last ran.
+
+	sync reads only _key and mod_time for the whole collection, which is cheap, then fetches the full objects for
+	keys that are new or whose mod_time has moved.  Those are hashed and compared with the snapshot so an object
+	that was saved without really changing isn't reported.  Keys that have gone are reported as deleted.
+
+	Each snapshot has a name (the type by default) so the same type can be tracked with different filters/fields.
+	Only the fields asked for are hashed so a job that cares about identifier and informational isn't told about
+	other changes.
+
+	example: the first run reports everything as added, after that only the changes
+		store = SyncStore('entities.db')
+		res = store.sync(cfg, 'entity', fields='_key,title,identifier,informational')
+		for e in res.added + res.changed:
+			...
+		for key in res.deleted:
+			...
+	"""
+	logger = logging.getLogger("splunk.bitsi.SyncStore")
+
+	# these change whenever an object is saved, they aren't part of its content
+	volatile = ('mod_time', 'mod_source', 'mod_timestamp')
+
+	def __init__(self, path):
+		self.path = path
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.execute("CREATE TABLE IF NOT EXISTS snapshot (name TEXT, key TEXT, mod_time TEXT, hash TEXT, "
+						"PRIMARY KEY (name, key))")
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+	'''
+	Work out what has been added, changed and deleted since the last sync of this snapshot and returns SyncResult
+	with lists of the added and changed objects and the deleted keys.
+
+	Params:
+		fields - csv list of fields to fetch for new/changed objects, blank is all of them
+		filter - only track objects that match this filter
+		name - name of the snapshot, defaults to type
+		chunk - number of keys fetched per request when reading new/changed objects
+		commit - save the new state straight away, if False call commit(name, result) once the changes are dealt with
+	'''
+	def sync(self, cfg, type, fields='', filter='', name=None, chunk=100, workers=1, commit=True):
+		name = name or type
+		start = time.time()
+		old = dict((k, (m, h)) for k, m, h in
+				   self.db.execute("SELECT key, mod_time, hash FROM snapshot WHERE name = ?", (name,)))
+
+		current = {}
+		for obj in cfg.iter_config(type, filter=filter, fields='_key,mod_time'):
+			current[obj['_key']] = self._mod_time(obj)
+
+		fetch = [k for k, m in current.items() if k not in old or m is None or m != old[k][0]]
+		deleted = [k for k in old if k not in current]
+
+		added, changed, touched = [], [], []
+		for obj in self._fetch(cfg, type, fields, fetch, chunk, workers):
+			key = obj['_key']
+			if key not in old:
+				added.append(obj)
+			elif self.hash(obj) != old[key][1]:
+				changed.append(obj)
+			else:
+				touched.append(obj)
+
+		res = SyncResult(added, changed, deleted, touched)
+		self.logger.info("%s: %d added, %d changed, %d deleted of %d in %0.1f secs", name, len(added), len(changed),
+						 len(deleted), len(current), time.time() - start)
+		if commit:
+			self.commit(name, res)
+		return res
+
+	'''
+	Save the state of the objects in a SyncResult as the snapshot
+	'''
+	def commit(self, name, result):
+		with self.db:
+			self.db.executemany("DELETE FROM snapshot WHERE name = ? AND key = ?", [(name, k) for k in result.deleted])
+			self.db.executemany("INSERT OR REPLACE INTO snapshot (name, key, mod_time, hash) VALUES (?, ?, ?, ?)",
+								[(name, o['_key'], self._mod_time(o), self.hash(o)) for o in result.added + result.changed + result.touched])
+
+	'''
+	forget a snapshot so the next sync reports everything as added
+	'''
+	def reset(self, name):
+		with self.db:
+			self.db.execute("DELETE FROM snapshot WHERE name = ?", (name,))
+
+	@staticmethod
+	def hash(obj):
+		content = dict((k, v) for k, v in obj.items() if k not in SyncStore.volatile)
+		return hashlib.sha1(json.dumps(content, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+	@staticmethod
+	def _mod_time(obj):
+		m = obj.get('mod_time')
+		return None if m is None else str(m)
+
+	def _fetch(self, cfg, type, fields, keys, chunk, workers):
+		if fields:
+			fields = ",".join(['_key', 'mod_time'] + [f for f in fields.split(',') if f not in ('_key', 'mod_time')])
+		chunks = [keys[i:i + chunk] for i in range(0, len(keys), chunk)]
+
+		def read(keys):
+			return list(cfg.iter_config(type, filter=Filter.in_('_key', keys), fields=fields))
+
+		if workers <= 1:
+			for c in chunks:
+				for obj in read(c):
+					yield obj
+			return
+		cfg._ensure_pool_size(workers)
+		pool = ThreadPool(workers)
+		try:
+			for objs in pool.imap_unordered(read, chunks):
+				for obj in objs:
+					yield obj
+		finally:
+			pool.terminate()
+
+
+class MultiConfig:
+	"""
+	Runs the same operation against several ITSI servers at once, one Config per server, and collects the results
+	per server so one bad server doesn't stop the others.
+
+	Any Config method can be called on a MultiConfig and it is run on every server, or use run with a function
+	that takes a Config as its first argument for anything more involved.  Both return a MultiResult.
+
+	example: push a template to 12 servers in the time it takes to push to one
+		multi = MultiConfig.from_hosts(hosts, user='admin', pswd=pswd)
+		res = multi.create_config('kpi_threshold_template', tpl)
+		for line in res.summary():
+			print(line)
+	"""
+	logger = logging.getLogger("splunk.bitsi.MultiConfig")
+
+	def __init__(self, configs, workers=None):
+		self.configs = list(configs)
+		self.workers = workers or len(self.configs)
+
+	@staticmethod
+	def from_hosts(hosts, user=None, port=None, pswd=None, **kwargs):
+		return MultiConfig([Config(host=h, user=user, port=port, pswd=pswd) for h in hosts], **kwargs)
+
+	def __getattr__(self, name):
+		if name.startswith('_') or not callable(getattr(Config, name, None)):
+			raise AttributeError(name)
+		return lambda *args, **kwargs: self.run(name, *args, **kwargs)
+
+	'''
+	Run fn on every server, fn is the name of a Config method or a function called as fn(cfg, *args, **kwargs)
+	returns MultiResult
+	'''
+	def run(self, fn, *args, **kwargs):
+		res = MultiResult()
+
+		def call(cfg):
+			start = time.time()
+			try:
+				if isinstance(fn, basestring):
+					val = getattr(cfg, fn)(*args, **kwargs)
+				else:
+					val = fn(cfg, *args, **kwargs)
+				err = None
+			except Exception as e:
+				val, err = None, e
+			return cfg, val, err, time.time() - start
+
+		pool = ThreadPool(max(1, min(self.workers, len(self.configs))))
+		try:
+			for cfg, val, err, secs in pool.imap_unordered(call, self.configs):
+				name = "%s:%d" % (cfg.host, cfg.port)
+				res.seconds[name] = secs
+				if err is None:
+					res.results[name] = val
+				else:
+					self.logger.error("%s failed on %s: %s", getattr(fn, '__name__', fn), name, err)
+					res.errors[name] = err
+		finally:
+			pool.terminate()
+		return res
+
+
+class MultiResult:
+	"""
+	What came back from each server in a MultiConfig call, all keyed on host:port
+		results - the return value from the servers that worked
+		errors - the exception raised by the servers that failed
+		seconds - how long each server took
+	"""
+	def __init__(self):
+		self.results = {}
+		self.errors = {}
+		self.seconds = {}
+
+	@property
+	def ok(self):
+		return len(self.errors) == 0
+
+	def summary(self):
+		res = []
+		for name in sorted(self.seconds):
+			if name in self.errors:
+				e = self.errors[name]
+				res.append("%s FAILED in %0.1f secs: %s" % (name, self.seconds[name], getattr(e, 'text', str(e))))
+			else:
+				res.append("%s OK in %0.1f secs" % (name, self.seconds[name]))
+		return res
+
+
+class RequestStats:
+	"""
+	Latency histograms and byte counts for the requests a Config makes, one series per method, object type,
+	operation and status.  op is read, count, bulk_update, templatize or the like, refresh_queue for the queue.
+
+	Dump them with to_json for logs and reports or prometheus for a textfile collector / pushgateway.
+
+	example:
+		cfg.bulk_write('entity', entities)
+		print(cfg.stats.to_json(indent=2))
+	"""
+	buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+	# these are operations rather than keys when they are the last part of the url
+	ops = ('count', 'bulk_update', 'templatize', 'get_supported_object_types')
+
+	def __init__(self):
+		self._series = {}
+		self._lock = threading.Lock()
+
+	'''
+	returns (type, op) for an itoa_interface url
+	'''
+	@staticmethod
+	def endpoint(url):
+		path = url.partition("?")[0]
+		if path.endswith("itsi_refresh_queue"):
+			return "itsi_refresh_queue", "refresh_queue"
+		parts = path.partition("/itoa_interface/")[2].split("/")
+		if parts[-1] in RequestStats.ops:
+			return (parts[0] if len(parts) > 1 else ""), parts[-1]
+		return parts[0], "object" if len(parts) > 1 else "collection"
+
+	def record(self, rec):
+		key = (rec['method'], rec['type'], rec['op'], rec['status'])
+		with self._lock:
+			s = self._series.get(key)
+			if s is None:
+				s = self._series[key] = {'count': 0, 'seconds': 0.0, 'bytes_sent': 0, 'bytes_received': 0,
+										 'wire_bytes_sent': 0, 'wire_bytes_received': 0, 'buckets': [0] * len(self.buckets)}
+			s['count'] += 1
+			s['seconds'] += rec['seconds']
+			s['bytes_sent'] += rec['bytes_sent']
+			s['bytes_received'] += rec['bytes_received']
+			s['wire_bytes_sent'] += rec.get('wire_bytes_sent', rec['bytes_sent'])
+			s['wire_bytes_received'] += rec.get('wire_bytes_received', rec['bytes_received'])
+			for i, le in enumerate(self.buckets):
+				if rec['seconds'] <= le:
+					s['buckets'][i] += 1
+					break
+
+	def reset(self):
+		with self._lock:
+			self._series = {}
+
+	'''
+	list of dicts, one per series, the bucket counts are cumulative like prometheus
+	'''
+	def to_list(self):
+		res = []
+		with self._lock:
+			for (method, type, op, status), s in sorted(self._series.items()):
+				n, cumulative = 0, []
+				for c in s['buckets']:
+					n += c
+					cumulative.append(n)
+				res.append({'method': method, 'type': type, 'op': op, 'status': status, 'count': s['count'],
+							'seconds': s['seconds'], 'bytes_sent': s['bytes_sent'], 'bytes_received': s['bytes_received'],
+							'wire_bytes_sent': s['wire_bytes_sent'], 'wire_bytes_received': s['wire_bytes_received'],
+							'buckets': dict(zip([str(b) for b in self.buckets], cumulative))})
+		return res
+
+	def to_json(self, **kwargs):
+		return json.dumps(self.to_list(), **kwargs)
+
+	def prometheus(self, prefix="bitsi_http"):
+		lines = [
+			"# HELP %s_request_seconds time taken by ITSI REST requests" % prefix,
+			"# TYPE %s_request_seconds histogram" % prefix
+		]
+		series = self.to_list()
+		for s in series:
+			labels = 'method="%s",type="%s",op="%s",status="%s"' % (s['method'], s['type'], s['op'], s['status'])
+			for b in self.buckets:
+				lines.append('%s_request_seconds_bucket{%s,le="%s"} %d' % (prefix, labels, b, s['buckets'][str(b)]))
+			lines.append('%s_request_seconds_bucket{%s,le="+Inf"} %d' % (prefix, labels, s['count']))
+			lines.append('%s_request_seconds_sum{%s} %f' % (prefix, labels, s['seconds']))
+			lines.append('%s_request_seconds_count{%s} %d' % (prefix, labels, s['count']))
+		for name, help in (('bytes_sent', 'request body bytes sent'), ('bytes_received', 'response body bytes received'),
+						   ('wire_bytes_sent', 'request body bytes sent after compression'),
+						   ('wire_bytes_received', 'response body bytes received before decompression')):
+			lines.append("# HELP %s_%s_total %s" % (prefix, name, help))
+			lines.append("# TYPE %s_%s_total counter" % (prefix, name))
+			for s in series:
+				labels = 'method="%s",type="%s",op="%s",status="%s"' % (s['method'], s['type'], s['op'], s['status'])
+				lines.append('%s_%s_total{%s} %d' % (prefix, name, labels, s[name]))
+		return "\n".join(lines) + "\n"
+
+
+class Serializer:
+	"""
+	JSON encoding and decoding for request and response bodies.
+
+	Uses the fastest library installed, orjson then simplejson, falling back to the standard json module, or name
+	one with backend.  dumps always returns utf-8 bytes with no padding and loads takes bytes or text.
+	iter_encode turns a list into a stream of byte chunks so a big bulk update can be sent without building
+	the whole body as one string (requests sends it chunked).
+	"""
+	logger = logging.getLogger("splunk.bitsi.Serializer")
+
+	backends = ('orjson', 'simplejson', 'json')
+
+	def __init__(self, backend=None, chunk_size=65536):
+		self.chunk_size = chunk_size
+		for name in ([backend] if backend else self.backends):
+			try:
+				self._mod = importlib.import_module(name)
+				self.name = name
+				break
+			except ImportError:
+				continue
+		else:
+			raise ItsiError("JSON backend %s is not installed" % backend)
+		self.logger.debug("using %s for json", self.name)
+
+	def dumps(self, obj):
+		if self.name == 'orjson':
+			# the stdlib turns int etc keys into strings, orjson refuses them unless told to do the same
+			return self._mod.dumps(obj, option=self._mod.OPT_NON_STR_KEYS)
+		res = self._mod.dumps(obj, separators=(',', ':'))
+		return res if isinstance(res, bytes) else res.encode('utf-8')
+
+	def loads(self, data):
+		return self._mod.loads(data)
+
+	def iter_encode(self, objs):
+		buf = [b'[']
+		size = 1
+		for i, obj in enumerate(objs):
+			if i > 0:
+				buf.append(b',')
+			b = self.dumps(obj)
+			buf.append(b)
+			size += len(b) + 1
+			if size >= self.chunk_size:
+				yield b''.join(buf)
+				buf, size = [], 0
+		buf.append(b']')
+		yield b''.join(buf)
+
+	'''
+	Generator of the items of a JSON array that arrives as a series of byte chunks (eg resp.iter_content), each
+	item is yielded as soon as it has all arrived.  Raises ItsiError if the data isn't a complete array.
+	'''
+	def iter_decode_array(self, chunks):
+		decoder = json.JSONDecoder()
+		text = codecs.getincrementaldecoder('utf-8')()
+		buf, pos = u'', 0
+		# what can come next: '[' to start, an item or ']' after '[', ',' or ']' after an item, an item after ','
+		expect = 'start'
+		for chunk in itertools.chain(chunks, [None]):
+			last = chunk is None
+			buf = buf[pos:] + text.decode(chunk or b'', final=last)
+			pos = 0
+			while True:
+				while pos < len(buf) and buf[pos] in u' \t\r\n':
+					pos += 1
+				if pos >= len(buf):
+					break
+				c = buf[pos]
+				if expect == 'start':
+					if c != u'[':
+						raise ItsiError("expected a JSON array but got: " + buf[pos:pos + 100])
+					expect = 'first'
+					pos += 1
+					continue
+				if c == u']' and expect in ('first', 'sep'):
+					return
+				if expect == 'sep':
+					if c != u',':
+						raise ItsiError("expected ',' or ']' in JSON array but got: " + buf[pos:pos + 100])
+					expect = 'item'
+					pos += 1
+					continue
+				if c in u',]':
+					raise ItsiError("expected an item in JSON array but got: " + buf[pos:pos + 100])
+				try:
+					obj, end = decoder.raw_decode(buf, pos)
+				except ValueError as e:
+					if last:
+						raise ItsiError("bad JSON in response: " + buf[pos:pos + 100], e)
+					break	# the rest of this item hasn't arrived yet
+				if not last and not isinstance(obj, (dict, list)) and (end == len(buf) or buf[end] not in u' \t\r\n,]'):
+					break	# a number or literal may have been cut short, wait until what ends it has arrived
+				yield obj
+				expect = 'sep'
+				pos = end
+		raise ItsiError("response ended before the JSON array was complete")
+
+
+class ObjectCache:
+	"""
+	LRU cache with a time to live, used by Config to hold templates and objects read by key.
+
+	Keys are tuples that start with (type, key, ...) so everything for a type or an object can be invalidated.
+	Values are deep copied going in and coming out so callers can change what they get without changing the cache,
+	get(key, shared=True) skips the copy out for callers that only read the value or clone() it.
+	max_size of 0 turns the cache off.
+	"""
+	def __init__(self, max_size=256, ttl=300):
+		self.max_size = max_size
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._items = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, shared=False):
+		with self._lock:
+			item = self._items.pop(key, None)
+			if item is None or item[0] < time.time():
+				self.misses += 1
+				return None
+			self._items[key] = item
+			self.hits += 1
+		return item[1] if shared else copy.deepcopy(item[1])
+
+	def put(self, key, value):
+		if self.max_size <= 0:
+			return
+		value = copy.deepcopy(value)
+		with self._lock:
+			self._items.pop(key, None)
+			self._items[key] = (time.time() + self.ttl, value)
+			while len(self._items) > self.max_size:
+				self._items.popitem(last=False)
+				self.evictions += 1
+
+	def invalidate(self, type=None, key=None):
+		with self._lock:
+			if type is None:
+				self._items.clear()
+				return
+			for k in [k for k in self._items if k[0] == type and (key is None or k[1] == key)]:
+				del self._items[k]
+
+	def stats(self):
+		return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
 class Filter:
+	"""
+	A mongo filter for read_config, get_count and delete_config (and LocalFilter).
+
+	Build them from the static methods and combine them with & and |, for example
+		f = Filter.regex("title", "^app|bah$", "i") & Filter.in_("services._key", [k1, k2])
+
+	The JSON is made once with sorted keys and no spaces so two filters that mean the same are the same string,
+	they compare equal and hash the same so they can be used as dict/cache keys.  str(f) is the JSON and
+	f.urlencoded() is what goes on the URL.  Values are escaped by json.dumps so quotes and backslashes in
+	values (or regexes) are safe.
+	"""
 	logger = logging.getLogger("splunk.bitsi.Filter")
 
-	def __init__(self):
-		pass
+	def __init__(self, spec=None):
+		self.spec = spec or {}
+		self._json = json.dumps(self.spec, sort_keys=True, separators=(',', ':'))
+		self._hash = hash(self._json)
+
+	def __str__(self):
+		return self._json
+
+	def __repr__(self):
+		return "Filter(%s)" % self._json
+
+	def __eq__(self, other):
+		if isinstance(other, Filter):
+			return self._json == other._json
+		return NotImplemented
+
+	def __ne__(self, other):
+		if isinstance(other, Filter):
+			return self._json != other._json
+		return True
+
+	def __hash__(self):
+		return self._hash
+
+	'''
+	True for a filter that matches everything, '', None, {} or Filter() - delete_config refuses these
+	'''
+	@staticmethod
+	def is_blank(filter):
+		if filter is None:
+			return True
+		if isinstance(filter, Filter):
+			return not filter.spec
+		if isinstance(filter, basestring):
+			return filter.strip() in ('', '{}')
+		return not filter
+
+	def __and__(self, other):
+		return Filter.and_(self, other)
+
+	def __or__(self, other):
+		return Filter.or_(self, other)
+
+	def urlencoded(self):
+		return quote(self._json, safe='')
+
+	@staticmethod
+	def eq(prop, val):
+		return Filter({prop: val})
+
+	@staticmethod
+	def regex(prop, pattern, flags=''):
+		cond = {"$regex": pattern}
+		if len(flags) > 0:
+			cond["$options"] = flags
+		return Filter({prop: cond})
+
+	@staticmethod
+	def in_(prop, values):
+		return Filter({prop: {"$in": list(values)}})
+
+	@staticmethod
+	def and_(*filters):
+		return Filter._combine("$and", filters)
+
+	@staticmethod
+	def or_(*filters):
+		return Filter._combine("$or", filters)
+
+	@staticmethod
+	def _combine(op, filters):
+		if not filters:
+			raise ItsiError("%s needs at least one filter" % op)
+		specs = []
+		for f in filters:
+			spec = f.spec if isinstance(f, Filter) else json.loads(f)
+			# flatten nested ands (or ors) so a & b & c is one $and of three
+			specs.extend(spec[op] if list(spec) == [op] else [spec])
+		return Filter(specs[0]) if len(specs) == 1 else Filter({op: specs})
 
 	'''
 	get a filter for a title or regex to query the KV store, 
@@ -366,27 +2439,65 @@ class Filter:
 	example: 
 		from itsi import Filter as F
 		titleFilter = F.title("my_service_name")
-		rexFilter = F.rex("^my.*", "i")
+		rexFilter = F.rex("title", "^my.*", "i")
 
-	Final note : title is solid but rex might give you issues
+	both return Filter objects now so $options end up inside the $regex condition where they belong
 	'''
 	@staticmethod
 	def rex(prop, val, flags=''):
-
-		_flgs = ''
-		if len(flags) > 0:
-			_flgs = ', {"$options" : "%s"}' % (flags)
-		res = '{"%s" : {"$regex":"%s"} %s}' % (prop, val, _flgs)
+		res = Filter.regex(prop, val, flags)
 		Filter.logger.info("created regex filter %s", res)
 		return res
 
 	@staticmethod
 	def title(val):
-		res = '{"title" : "%s" }' % (val)
+		res = Filter.eq("title", val)
 		Filter.logger.info("created title filter %s", res)
 		return res
 
 
+'''
+A copy of base with changes applied that shares everything it doesn't change with base, only the dicts and lists
+on the path to each change are copied.  Making lots of variants of a big template this way costs in proportion
+to the changes not the size of the template, and the result is plain dicts and lists so it serializes as is.
+
+changes maps a dotted path (or a tuple of keys, for keys with dots in) to its new value, list items are
+addressed by their index and missing dicts along a path are made.  As the rest is shared neither base nor the
+clone should be changed in place afterwards except through the paths that were cloned, clone the clone instead.
+
+example: a threshold template per name without deep copying the base each time
+	for name, policies in templates.items():
+		tpl = clone(base, {'title': name, 'time_variate_thresholds_specification.policies': policies})
+'''
+def clone(base, changes=None):
+	copied = set()
+
+	def own(node):
+		node = list(node) if isinstance(node, list) else dict(node)
+		copied.add(id(node))
+		return node
+
+	def index(node, k):
+		return int(k) if isinstance(node, list) else k
+
+	res = own(base)
+	for path, value in (changes or {}).items():
+		keys = path.split('.') if isinstance(path, basestring) else list(path)
+		node = res
+		for k in keys[:-1]:
+			k = index(node, k)
+			child = node[k] if isinstance(node, list) else node.get(k)
+			if child is None:
+				child = {}
+				copied.add(id(child))
+			elif id(child) not in copied:
+				child = own(child)
+			node[k] = child
+			node = child
+		node[index(node, keys[-1])] = value
+	return res
+
+
 def setup_logging(level='info',
 			fmt = '%(asctime)s %(levelname)s [%(lineno)d:%(module)s:%(funcName)s:%(name)s] >> %(message)s'):
 	lvl = getattr(logging, level.upper(), getattr(logging, "WARN"))
@@ -407,8 +2518,8 @@ def main(args):
 
 	cfg = Config()
 	cfg.set_host("itsiaws")
-	print cfg.get_refresh_q_size()
-	print "done"
+	print(cfg.get_refresh_q_size())
+	print("done")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,185 @@
+'''
+**AsyncConfig**
+
+asyncio version of itsi.Config for driving one or many ITSI servers from an event loop.
+
+The methods match Config (read_config, get_count, list_types, get_template, create_config, update_config,
+bulk_update_config, delete_config, get_refresh_q_size) but are coroutines.  Requests go through a pooled aiohttp
+connector so the number of connections open at once is limited overall (limit) and per server (limit_per_host),
+as many calls as you like can be started and they queue for a connection rather than running one after another.
+
+This needs python 3.5+ and aiohttp, the rest of bitsi still runs on python 2.
+
+example: count every type on two servers at once
+	import asyncio
+	from itsi_async import AsyncConfig
+
+	async def count_all(cfg):
+		async with cfg:
+			types = await cfg.list_types()
+			counts = await asyncio.gather(*[cfg.get_count(t) for t in types], return_exceptions=True)
+			return dict(zip(types, counts))
+
+	loop = asyncio.get_event_loop()
+	res = loop.run_until_complete(asyncio.gather(count_all(AsyncConfig('itsi1')), count_all(AsyncConfig('itsi2'))))
+
+'''
+
+import asyncio, logging
+import aiohttp
+
+import itsi
+from itsi import ItsiError, ObjectCache, Serializer, Filter
+
+
+class AsyncConfig:
+	user = itsi.Config.user
+	pswd = itsi.Config.pswd
+	host = itsi.Config.host
+	port = itsi.Config.port
+	page_size = itsi.Config.page_size
+	cache_size = itsi.Config.cache_size
+	cache_ttl = itsi.Config.cache_ttl
+
+	logger = logging.getLogger("splunk.bitsi.AsyncConfig")
+
+	# the url building is the same as Config
+	_get_url = itsi.Config._get_url
+	_filter_param = itsi.Config._filter_param
+	_get_uuids = itsi.Config._get_uuids
+	fix_kpis = itsi.Config.fix_kpis
+	add_uuids = itsi.Config.add_uuids
+
+	def __init__(self, host=None, user=None, port=None, pswd=None, limit=100, limit_per_host=20, timeout=300,
+				 serializer=None):
+		self.host = host or self.host
+		self.user = user or self.user
+		self.port = port or self.port
+		self.pswd = pswd or self.pswd
+		self.limit = limit
+		self.limit_per_host = limit_per_host
+		self.timeout = timeout
+		self.templateCache = ObjectCache(self.cache_size, self.cache_ttl)
+		self.serializer = serializer or Serializer()
+		self.session = None
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def close(self):
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
+
+	async def get_count(self, type='service', filter=''):
+		params = []
+		if filter != '':
+			params.append(self._filter_param(filter))
+		return (await self._request('GET', self._get_url([type, 'count'], params)))['count']
+
+	async def list_types(self):
+		return await self._request('GET', self._get_url(['get_supported_object_types']))
+
+	'''
+	Same as Config.read_config, for a collection the count is read first then all the pages are fetched at once
+	'''
+	async def read_config(self, type="service", key='', filter='', fields='title,_key', limit=0, page_size=None):
+		params = []
+		if len(fields) > 0:
+			params.append("fields=" + fields)
+		if len(key) > 0:
+			obj = self.templateCache.get((type, key, fields))
+			if obj is None:
+				obj = await self._request('GET', self._get_url([type, key], params))
+				self.templateCache.put((type, key, fields), obj)
+			return obj
+
+		if filter != '':
+			params.append(self._filter_param(filter))
+		page_size = page_size or self.page_size
+		total = await self.get_count(type, filter)
+		if limit > 0:
+			total = min(total, limit)
+		pages = await asyncio.gather(*[
+			self._request('GET', self._get_url([type], params + ["skip=%d" % skip, "limit=%d" % min(page_size, total - skip),
+																  "sort_key=_key&sort_dir=1"]))
+			for skip in range(0, total, page_size)])
+		return [obj for page in pages for obj in page]
+
+	async def get_template(self, uuid, type="service"):
+		tpl = self.templateCache.get((type, uuid, "templatize"))
+		if tpl is None:
+			tpl = await self._request('GET', self._get_url([type, uuid, "templatize"]))
+			self.templateCache.put((type, uuid, "templatize"), tpl)
+		return tpl
+
+	async def get_refresh_q_size(self):
+		url = "https://%s:%d/servicesNS/nobody/SA-ITOA/storage/collections/data/itsi_refresh_queue" \
+				% (self.host, self.port)
+		try:
+			return len(await self._request('GET', url))
+		except Exception as e:
+			self.logger.error("Failed to fetch the queue: " + str(e))
+		return -1
+
+	async def delete_config(self, type, key='', filter=''):
+		uris = [type]
+		if key == '' and Filter.is_blank(filter):
+			raise ItsiError('key and filter are blank, please supply one value or all objects of this type will be deleted')
+		elif key != '':
+			uris.append(key)
+		self.templateCache.invalidate(type, key or None)
+		url = self._get_url(uris, [self._filter_param(filter)])
+		self.logger.info("Delete URL = " + url)
+		async with self._get_session().delete(url, auth=self._auth()) as resp:
+			return resp.status < 400
+
+	async def update_config(self, type, template, key):
+		self.templateCache.invalidate(type, key)
+		return await self._request('POST', self._get_url([type, key], ['is_partial_data=1']), template)
+
+	async def bulk_update_config(self, type, data, partial=True):
+		for obj in data:
+			self.templateCache.invalidate(type, obj.get('_key') or None)
+		return await self._request('POST', self._get_url([type, "bulk_update"], ['is_partial_data=%d' % partial]), data)
+
+	async def create_config(self, type, template):
+		return await self._request('POST', self._get_url([type], []), template)
+
+	# --------------------------------------------------------------------------
+	# -----------------  Private functions used in this module -----------------
+
+	def _auth(self):
+		return aiohttp.BasicAuth(self.user, self.pswd)
+
+	'''
+	The session has to be made inside the event loop so its made on first use
+	'''
+	def _get_session(self):
+		if self.session is None:
+			connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, ssl=False)
+			self.session = aiohttp.ClientSession(connector=connector,
+												 timeout=aiohttp.ClientTimeout(total=self.timeout))
+		return self.session
+
+	'''
+	Send the request and decode the json response or raise an ItsiError, the same as Config._get_json_or_die
+	'''
+	async def _request(self, method, url, data=None):
+		kwargs = {'auth': self._auth()}
+		if data is not None:
+			kwargs['data'] = self.serializer.dumps(data)
+			kwargs['headers'] = {'Content-Type': 'application/json'}
+		try:
+			async with self._get_session().request(method, url, **kwargs) as resp:
+				body = await resp.read()
+				if resp.status >= 400:
+					raise ItsiError("%d %s: %s" % (resp.status, resp.reason, body.decode('utf-8', 'replace')))
+				return self.serializer.loads(body)
+		except aiohttp.ClientError as e:
+			raise ItsiError("Request failed: " + url, e)
+		except ValueError as e:
+			raise ItsiError("Base error: " + body.decode('utf-8', 'replace'), e)
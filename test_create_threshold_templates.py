@@ -0,0 +1,60 @@
+"""
+Tests for reading the threshold definitions in create_threshold_templates.py, run them with pytest from this directory
+"""
+
+import datetime
+import logging
+import os
+
+import pytest
+
+import create_threshold_templates as ctt
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+HEADERS = ['template', 'disabled', 'days', 'start', 'end', 'type', 'AGG_BASE', 'AT1', 'AV1', 'ENT_BASE', 'ET1', 'EV1']
+
+
+@pytest.fixture(autouse=True)
+def logger(monkeypatch):
+	# the script sets its logger up in __main__
+	monkeypatch.setattr(ctt, 'logger', logging.getLogger("splunk.bitsi.create_threshold_templates"), raising=False)
+
+
+def test_cell_text():
+	assert ctt.cell_text(None) == ''
+	assert ctt.cell_text(5.0) == '5' and ctt.cell_text(1.5) == '1.5' and ctt.cell_text(3) == '3'
+	assert ctt.cell_text(u'0-4') == u'0-4'
+	assert ctt.cell_text(datetime.time(1, 0)) == '01:00'
+	assert ctt.cell_text(datetime.time(13, 45, 30)) == '13:45'
+	assert ctt.cell_text(datetime.datetime(1899, 12, 30, 2, 30)) == '02:30'
+
+
+def test_xlsx_matches_csv():
+	pytest.importorskip('openpyxl')
+	csv_errors, xlsx_errors = [], []
+	from_csv = list(ctt.read_templates(os.path.join(DATA, 'example_thresholds.csv'), 'regular', csv_errors))
+	from_xlsx = list(ctt.read_templates(os.path.join(DATA, 'example_thresholds.xlsx'), 'regular', xlsx_errors))
+	assert from_csv and from_xlsx == from_csv
+	assert xlsx_errors == csv_errors
+
+
+def test_xlsx_time_cells(tmpdir):
+	openpyxl = pytest.importorskip('openpyxl')
+	wb = openpyxl.Workbook()
+	ws = wb.active
+	ws.append(HEADERS)
+	ws.append(['t1', None, 1, datetime.time(1, 0), datetime.time(2, 30), 'range', 'normal', 'high', 2, 'normal',
+			   'high', 95])
+	ws.append(['t1', None, '0-4', datetime.time(22, 0), datetime.time(0, 0), 'stdev', 'normal', 'high', 2.5, 'normal',
+			   'high', 90])
+	ws.append(['t2', None, 2, 'x', 'x', 'range', 'normal', 'high', 2, 'normal', 'high', 95])
+	path = str(tmpdir.join('custom.xlsx'))
+	wb.save(path)
+
+	errors = []
+	res = dict(ctt.read_templates(path, 'custom', errors))
+	assert sorted(res) == ['t1']
+	blocks = sorted(p['time_blocks'][0] for t, p in res['t1']['policies'].items() if t != 'default_policy')
+	assert blocks == [['0 1 * * 1', 90], ['0 22 * * 0-4', 120]]
+	assert [(line, t) for line, t, problem in errors] == [(4, 't2'), (4, 't2')]
@@ -0,0 +1,671 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for itsi.py that don't need a server, run them with pytest from this directory
+"""
+
+import json
+import time
+
+import pytest
+import requests
+
+import itsi
+from itsi import ItsiError, Filter, LocalFilter
+
+try:
+	from urllib.parse import urlparse, parse_qs
+except ImportError:
+	from urlparse import urlparse, parse_qs
+
+
+def entity(key, title, aliases=(), infos=(), **extra):
+	obj = {
+		'_key': key,
+		'title': title,
+		'identifier': {'fields': [f for f, v in aliases], 'values': [v for f, v in aliases]},
+		'informational': {'fields': [f for f, v in infos], 'values': [v for f, v in infos]}
+	}
+	obj.update(extra)
+	return obj
+
+
+ENTITIES = [
+	entity('1', 'host1', [('host', 'host1'), ('ip', '10.0.0.1')], [('vendor_product', 'operating_system_host')]),
+	entity('2', 'HOST2', [('host', 'host2'), ('disk_name', 'sda')], [('site', 'syd')]),
+	entity('3', 'san1', [('dv_name', 'host1')], [('vendor_product', 'operating_system_host'), ('site', 'mel')],
+		   services=[{'_key': 's1', 'title': 'web'}, {'_key': 's2', 'title': 'db'}]),
+]
+
+
+class StubResponse(object):
+	def __init__(self, body, status_code=200):
+		self.content = json.dumps(body).encode('utf-8')
+		self.text = self.content.decode('utf-8')
+		self.status_code = status_code
+		self.ok = status_code < 400
+		self.raw = None
+
+	def raise_for_status(self):
+		if not self.ok:
+			raise requests.exceptions.HTTPError("%d error" % self.status_code)
+
+	def iter_content(self, chunk_size=1):
+		for i in range(0, len(self.content), chunk_size):
+			yield self.content[i:i + chunk_size]
+
+	def close(self):
+		pass
+
+
+class StubSession(object):
+	"""
+	Stands in for the requests.Session of a Config, answers from a list of entities the way the server would
+	and keeps every call in calls as (method, path, query, body)
+	"""
+
+	def __init__(self, entities=()):
+		self.entities = [dict(e) for e in entities]
+		self.calls = []
+
+	def request(self, method, url, data=None, **kwargs):
+		u = urlparse(url)
+		query = parse_qs(u.query)
+		if data is not None and not isinstance(data, bytes):
+			data = b''.join(data)
+		body = json.loads(data.decode('utf-8')) if data else None
+		self.calls.append((method, u.path, query, body))
+
+		path = u.path.split('/itoa_interface/')[-1].split('/')
+		objs = self.entities
+		if 'filter' in query:
+			objs = list(LocalFilter.compile(query['filter'][0]).select(objs))
+		if method == 'DELETE':
+			keys = set(e['_key'] for e in objs)
+			self.entities = [e for e in self.entities if e['_key'] not in keys]
+			return StubResponse(None)
+		if method == 'POST':
+			# a bulk update, partial or not each object only replaces the fields it has
+			stored = dict((e['_key'], e) for e in self.entities)
+			for o in body:
+				stored[o['_key']].update(o)
+			return StubResponse([o['_key'] for o in body])
+		if path[-1] == 'count':
+			return StubResponse({'count': len(objs)})
+		if 'itsi_refresh_queue' in u.path:
+			return StubResponse([])
+		skip = int(query.get('skip', ['0'])[0])
+		limit = int(query.get('limit', ['0'])[0]) or len(objs)
+		objs = objs[skip:skip + limit]
+		if query.get('fields'):
+			fields = query['fields'][0].split(',')
+			objs = [dict((k, v) for k, v in o.items() if k in fields) for o in objs]
+		return StubResponse(objs)
+
+
+def stub_config(entities=()):
+	cfg = itsi.Config('stub', user='admin', pswd='changeme')
+	cfg.session = StubSession(entities)
+	return cfg
+
+
+def pairs(section):
+	return sorted(zip(section['fields'], section['values']))
+
+
+def titles(f):
+	return [e['title'] for e in LocalFilter.compile(f).select(ENTITIES)]
+
+
+def test_LocalFilter_exact():
+	assert titles('{"title": "host1"}') == ['host1']
+	assert titles({"title": "nope"}) == []
+
+
+def test_LocalFilter_regex():
+	assert titles('{"title": {"$regex": "^host"}}') == ['host1']
+	assert titles('{"title": {"$regex": "^host", "$options": "i"}}') == ['host1', 'HOST2']
+
+
+def test_LocalFilter_in_and_eq():
+	assert titles({"title": {"$in": ["san1", "HOST2"]}}) == ['HOST2', 'san1']
+	assert titles({"title": {"$eq": "san1"}}) == ['san1']
+
+
+def test_LocalFilter_dotted_paths_match_any_list_item():
+	assert titles('{"identifier.fields": {"$regex": "^host$"}}') == ['host1', 'HOST2']
+	assert titles({"identifier.values": "sda"}) == ['HOST2']
+	assert titles({"services.title": "db"}) == ['san1']
+	# the list itself is a value too
+	assert titles({"identifier.fields": ["dv_name"]}) == ['san1']
+
+
+def test_LocalFilter_and_or():
+	assert titles({"$or": [{"title": "host1"}, {"informational.values": "syd"}]}) == ['host1', 'HOST2']
+	assert titles({"$and": [{"informational.values": "operating_system_host"}, {"informational.values": "mel"}]}) \
+		== ['san1']
+	# several fields in one filter are and'ed
+	assert titles({"informational.fields": "vendor_product", "identifier.fields": "ip"}) == ['host1']
+
+
+def test_LocalFilter_missing_path():
+	assert titles({"description": "x"}) == []
+	assert titles({"services.nope": "x"}) == []
+
+
+def test_LocalFilter_Filter_and_Entity():
+	f = itsi.Filter.regex("identifier.fields", "^host$") & itsi.Filter.eq("informational.values", "syd")
+	assert titles(f) == ['HOST2']
+	e = itsi.Entity.from_json(ENTITIES[1])
+	assert LocalFilter.compile(f).match(e)
+
+
+def test_LocalFilter_empty_matches_everything():
+	assert titles('{}') == ['host1', 'HOST2', 'san1']
+	assert titles(itsi.Filter()) == ['host1', 'HOST2', 'san1']
+
+
+def test_LocalFilter_compiled_once():
+	f = '{"title": {"$regex": "^san"}}'
+	assert LocalFilter.compile(f) is LocalFilter.compile(f)
+
+
+def test_LocalFilter_unsupported_operators():
+	with pytest.raises(ItsiError):
+		LocalFilter({"title": {"$gt": "a"}})
+	with pytest.raises(ItsiError):
+		LocalFilter({"$nor": [{"title": "a"}]})
+
+
+def test_Filter_json_is_canonical():
+	a = Filter({"title": "x", "_key": "1"})
+	b = Filter({"_key": "1", "title": "x"})
+	assert str(a) == '{"_key":"1","title":"x"}'
+	assert a == b and hash(a) == hash(b)
+	assert a != Filter.eq("title", "x")
+	assert len(set([a, b])) == 1
+
+
+def test_Filter_builders():
+	assert Filter.eq("title", "x").spec == {"title": "x"}
+	assert Filter.regex("title", "^a", "i").spec == {"title": {"$regex": "^a", "$options": "i"}}
+	assert Filter.regex("title", "^a").spec == {"title": {"$regex": "^a"}}
+	assert Filter.in_("_key", ("1", "2")).spec == {"_key": {"$in": ["1", "2"]}}
+	assert Filter.title("x") == Filter.eq("title", "x")
+	assert Filter.rex("title", "^a", "i") == Filter.regex("title", "^a", "i")
+
+
+def test_Filter_values_are_escaped():
+	f = Filter.eq("title", 'say "hi" \\ bye')
+	assert json.loads(str(f)) == {"title": 'say "hi" \\ bye'}
+	assert '"' not in f.urlencoded() and ' ' not in f.urlencoded()
+
+
+def test_Filter_combine_flattens():
+	a, b, c = Filter.eq("a", 1), Filter.eq("b", 2), Filter.eq("c", 3)
+	assert (a & b & c).spec == {"$and": [{"a": 1}, {"b": 2}, {"c": 3}]}
+	assert (a | b | c).spec == {"$or": [{"a": 1}, {"b": 2}, {"c": 3}]}
+	assert ((a | b) & c).spec == {"$and": [{"$or": [{"a": 1}, {"b": 2}]}, {"c": 3}]}
+	assert Filter.and_(a, '{"b": 2}').spec == {"$and": [{"a": 1}, {"b": 2}]}
+	assert Filter.or_(a) == a
+
+
+def test_Filter_combine_needs_a_filter():
+	with pytest.raises(ItsiError):
+		Filter.and_()
+	with pytest.raises(ItsiError):
+		Filter.or_()
+
+
+def test_Filter_is_blank():
+	for f in (None, '', '  ', '{}', ' {} ', {}, Filter(), Filter({})):
+		assert Filter.is_blank(f), f
+	for f in (Filter.eq("title", "x"), '{"title": "x"}', {"title": "x"}):
+		assert not Filter.is_blank(f), f
+
+
+def test_delete_config_refuses_blank_filters():
+	cfg = stub_config(ENTITIES)
+	for f in ('', '{}', Filter(), None):
+		with pytest.raises(ItsiError):
+			cfg.delete_config('entity', filter=f)
+	assert cfg.session.calls == []
+	assert len(cfg.session.entities) == 3
+
+
+def test_delete_config_by_filter():
+	cfg = stub_config(ENTITIES)
+	assert cfg.delete_config('entity', filter=Filter.in_('_key', ['1', '3']))
+	method, path, query, body = cfg.session.calls[0]
+	assert method == 'DELETE' and path.endswith('/entity')
+	assert json.loads(query['filter'][0]) == {"_key": {"$in": ["1", "3"]}}
+	assert [e['_key'] for e in cfg.session.entities] == ['2']
+
+
+def decode(text, chunk_size):
+	data = text.encode('utf-8')
+	chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+	return list(itsi.Serializer('json').iter_decode_array(chunks))
+
+
+@pytest.mark.parametrize('text', [
+	'[]',
+	' [ ] ',
+	'[1,2]',
+	'[ 1 ,\n 2 ]',
+	'[{"a": [1, 2], "b": "x,y]"}, "[,]", -1.5e3, 12345, null, true, false]',
+	u'["é中", {"k": "ü"}]',
+])
+def test_iter_decode_array(text):
+	# every chunk size so items, numbers and multi-byte characters get split at every point
+	for n in range(1, len(text.encode('utf-8')) + 1):
+		assert decode(text, n) == json.loads(text), n
+
+
+@pytest.mark.parametrize('text', ['[1,,,2]', '[,1]', '[1,]', '[,]', '[1 2]', '{"a": 1}', '1', '[1', '[1,', '[1.]', ''])
+def test_iter_decode_array_rejects_bad_arrays(text):
+	for n in (1, 2, 100):
+		with pytest.raises(ItsiError):
+			decode(text, n)
+
+
+def test_iter_decode_array_yields_items_as_they_arrive():
+	got = []
+
+	def chunks():
+		yield b'[{"a": 1}, {"b"'
+		assert got == [{"a": 1}]
+		yield b': 2}]'
+
+	for obj in itsi.Serializer('json').iter_decode_array(chunks()):
+		got.append(obj)
+	assert got == [{"a": 1}, {"b": 2}]
+
+
+def test_stream_config():
+	cfg = stub_config(ENTITIES)
+	assert [e['_key'] for e in cfg.stream_config('entity', chunk_size=7)] == ['1', '2', '3']
+	assert [e['_key'] for e in cfg.stream_config('entity', filter=Filter.eq('title', 'san1'))] == ['3']
+
+
+def many(n):
+	return [entity('%04d' % i, 'e%d' % i) for i in range(n)]
+
+
+def pages_read(cfg):
+	return [c for c in cfg.session.calls if 'skip' in c[2]]
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_iter_config_parallel(ordered):
+	cfg = stub_config(many(95))
+	keys = [e['_key'] for e in cfg.iter_config_parallel('entity', page_size=10, workers=3, ordered=ordered)]
+	if ordered:
+		assert keys == ['%04d' % i for i in range(95)]
+	else:
+		assert sorted(keys) == ['%04d' % i for i in range(95)]
+	assert len(pages_read(cfg)) == 10
+
+
+def test_iter_config_parallel_reads_ahead_of_the_caller_by_workers_pages():
+	cfg = stub_config(many(200))
+	objs = cfg.iter_config_parallel('entity', page_size=10, workers=3)
+	next(objs)
+	time.sleep(0.2)
+	# the page being read and the next workers of them, not all 20
+	assert len(pages_read(cfg)) <= 4
+	assert len(list(objs)) == 199
+
+
+def test_iter_config_parallel_added_after_the_count():
+	cfg = stub_config(many(25))
+	real_request = cfg.session.request
+
+	def request(method, url, **kwargs):
+		res = real_request(method, url, **kwargs)
+		if url.split('?')[0].endswith('/count'):
+			cfg.session.entities.extend(many(40)[25:])
+		return res
+	cfg.session.request = request
+	keys = [e['_key'] for e in cfg.iter_config_parallel('entity', page_size=10, workers=2)]
+	assert keys == ['%04d' % i for i in range(40)]
+
+
+def test_iter_config_parallel_page_error():
+	cfg = stub_config(many(50))
+	real_request = cfg.session.request
+
+	def request(method, url, **kwargs):
+		if 'skip=20&' in url:
+			return StubResponse({'messages': 'boom'}, 500)
+		return real_request(method, url, **kwargs)
+	cfg.session.request = request
+	with pytest.raises(ItsiError):
+		list(cfg.iter_config_parallel('entity', page_size=10, workers=2))
+
+
+def test_clone():
+	base = {'title': 'base', 'a': {'b': {'c': 1}, 'big': list(range(10))}, 'kpis': [{'title': 'k1'}, {'title': 'k2'}]}
+	before = json.dumps(base, sort_keys=True)
+	res = itsi.clone(base, {'title': 'new', 'a.b.c': 2, 'kpis.1.title': 'k3', ('x.y', 'z'): 3, 'm.n': 4})
+
+	assert res == {'title': 'new', 'a': {'b': {'c': 2}, 'big': list(range(10))},
+				   'kpis': [{'title': 'k1'}, {'title': 'k3'}], 'x.y': {'z': 3}, 'm': {'n': 4}}
+	# base is untouched and whatever wasn't on the path to a change is shared
+	assert json.dumps(base, sort_keys=True) == before
+	assert res['a'] is not base['a'] and res['a']['b'] is not base['a']['b']
+	assert res['a']['big'] is base['a']['big']
+	assert res['kpis'] is not base['kpis'] and res['kpis'][0] is base['kpis'][0]
+
+
+def test_clone_of_a_clone():
+	base = {'a': {'b': 1}, 'c': {'d': 2}}
+	one = itsi.clone(base, {'a.b': 10})
+	two = itsi.clone(one, {'a.b': 20, 'c.d': 30})
+	assert base == {'a': {'b': 1}, 'c': {'d': 2}}
+	assert one == {'a': {'b': 10}, 'c': {'d': 2}}
+	assert two == {'a': {'b': 20}, 'c': {'d': 30}}
+
+
+def test_clone_without_changes():
+	base = {'a': {'b': 1}}
+	res = itsi.clone(base)
+	assert res == base and res is not base and res['a'] is base['a']
+
+
+def test_Entity_round_trip():
+	obj = entity('k', 't', [('host', 'h1'), ('ip', '1.1.1.1'), ('host', 'h2'), ('host', 'h3')],
+				 [('site', 'syd'), ('role', 'db')], description='d', services=[{'_key': 's'}])
+	obj['informational']['values'].append('orphan')
+	e = itsi.Entity.from_json(obj)
+	res = e.to_json()
+	# the order of the fields can change but every pair and the value without a field come back
+	for section in ('identifier', 'informational'):
+		assert pairs(res[section]) == pairs(obj[section])
+		assert len(res[section]['values']) == len(obj[section]['values'])
+	assert res['informational']['values'][-1] == 'orphan'
+	assert dict(res, identifier=None, informational=None) == dict(obj, identifier=None, informational=None)
+	assert e.get_alias('host') == 'h1' and e.get_info('role') == 'db' and e.get_alias('nope') is None
+	assert sorted(e.alias_pairs()) == [('host', 'h1'), ('host', 'h2'), ('host', 'h3'), ('ip', '1.1.1.1')]
+	assert not e.is_dirty() and e.changes() is None
+
+
+def test_Entity_repeated_fields():
+	e = itsi.Entity.from_json(entity('k', 't', [('host', 'h1'), ('ip', '1.1.1.1'), ('host', 'h2')], [('host', 'old')]))
+	assert e.move_alias_to_info('host')
+	assert e.alias_pairs() == [('ip', '1.1.1.1')]
+	assert sorted(e.info_pairs()) == [('host', 'h1'), ('host', 'h2'), ('host', 'old')]
+	assert e.changes() == {'_key': 'k', 'identifier': {'fields': ['ip'], 'values': ['1.1.1.1']},
+						   'informational': e.to_json()['informational']}
+	assert not e.move_alias_to_info('host')
+
+	e.add_alias('ip', '2.2.2.2')
+	assert e.pop_alias('ip') == ['1.1.1.1', '2.2.2.2']
+	assert e.pop_alias('ip') == [] and e.del_info('nope') is None
+
+
+def test_Entity_changes():
+	e = itsi.Entity.from_json(entity('k', 't', [('host', 'h1')], [('site', 'syd')], description='d'))
+	e.set_alias('host', 'h1')
+	e.set('description', 'd')
+	assert not e.is_dirty()
+	e.set_title('t2')
+	e.set_info('site', 'mel')
+	e.set('description', 'd2')
+	assert e.dirty_fields() == set(['title', 'informational', 'description'])
+	assert e.changes() == {'_key': 'k', 'title': 't2', 'description': 'd2',
+						   'informational': {'fields': ['site'], 'values': ['mel']}}
+	e.mark_clean()
+	assert e.changes() is None
+	assert e.to_json() == entity('k', 't2', [('host', 'h1')], [('site', 'mel')], description='d2')
+
+
+def test_Entity_interns_field_names_only():
+	a = itsi.Entity.from_json(entity('1', 't', [(''.join(['ho', 'st']), ''.join(['h', '1']))]))
+	b = itsi.Entity.from_json(entity('2', 't', [(''.join(['ho', 'st']), ''.join(['h', '1']))]))
+	fa, = a.aliases
+	fb, = b.aliases
+	assert fa is fb
+	assert 'host' in itsi.Entity._strings and 'h1' not in itsi.Entity._strings
+
+
+OS_HOSTS = Filter.eq("informational.values", "operating_system_host") & Filter.eq("identifier.fields", "host")
+DV_HOSTS = Filter.eq("identifier.fields", "dv_name")
+
+
+def pipeline():
+	return itsi.EntityPipeline([itsi.MoveAliasToInfo('disk_name'), itsi.RenameField('site', 'location', 'informational'),
+								itsi.MergeEntities(OS_HOSTS, 'host', DV_HOSTS, 'dv_name')])
+
+
+def test_EntityPipeline_filter():
+	assert itsi.EntityPipeline([itsi.MoveAliasToInfo('a'), itsi.MoveAliasToInfo('b')]).filter() == \
+		Filter.in_('identifier.fields', ['a']) | Filter.in_('identifier.fields', ['b'])
+	assert itsi.EntityPipeline([]).filter() == ''
+
+
+def test_EntityPipeline_apply():
+	res = pipeline().apply(itsi.Entity.from_json(e) for e in ENTITIES)
+	assert res['read'] == 3 and res['changed'] == 2
+	assert res['merged'] == [('3', '1')]
+	one, two = res['entities']
+	assert one.key == '1' and two.key == '2'
+	assert sorted(one.alias_pairs()) == [('dv_name', 'host1'), ('host', 'host1'), ('ip', '10.0.0.1')]
+	assert sorted(one.info_pairs()) == [('location', 'mel'), ('vendor_product', 'operating_system_host')]
+	assert two.alias_pairs() == [('host', 'host2')]
+	assert sorted(two.info_pairs()) == [('disk_name', 'sda'), ('location', 'syd')]
+	assert res['diff'][:3] == ["~ host1 (1)", "    alias +dv_name=host1", "    info +location=mel"]
+	assert res['diff'][3] == "~ HOST2 (2)"
+	assert sorted(res['diff'][4:8]) == ["    alias -disk_name=sda", "    info +disk_name=sda", "    info +location=syd",
+										"    info -site=syd"]
+	assert res['diff'][8:] == ["- san1 (3) merged into host1 (1)"]
+
+
+def test_EntityPipeline_entity_read_twice():
+	# a paged read can return the same entity twice, one that matches both sides of the merge mustn't merge into
+	# its own copy and get deleted
+	e = entity('9', 'both', [('host', 'x'), ('dv_name', 'x'), ('disk_name', 'sdb')],
+			   [('vendor_product', 'operating_system_host')])
+	res = pipeline().apply([itsi.Entity.from_json(e), itsi.Entity.from_json(e)])
+	assert res['read'] == 2 and res['merged'] == []
+	assert [c.key for c in res['entities']] == ['9']
+	assert res['diff'][0] == "~ both (9)" and "    info +disk_name=sdb" in res['diff']
+
+
+def test_EntityPipeline_dryrun():
+	cfg = stub_config(ENTITIES)
+	res = pipeline().run(cfg, dryrun=True)
+	assert res['read'] == 3 and res['changed'] == 2 and res['merged'] == [('3', '1')]
+	assert res['write'] is None and res['deleted'] == 0 and 'entities' not in res
+	assert len(res['diff']) == 9
+	assert [c[0] for c in cfg.session.calls] == ['GET']
+	assert cfg.session.entities == ENTITIES
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_EntityPipeline_run(workers):
+	cfg = stub_config(ENTITIES)
+	res = pipeline().run(cfg, workers=workers)
+	assert res['write']['objects'] == 2 and res['write']['failed'] == [] and res['deleted'] == 1
+	# only what changed is sent
+	posts = [c[3] for c in cfg.session.calls if c[0] == 'POST']
+	assert len(posts) == 1
+	assert [(o['_key'], sorted(o), pairs(o['identifier']), pairs(o['informational'])) for o in posts[0]] == [
+		('1', ['_key', 'identifier', 'informational'], [('dv_name', 'host1'), ('host', 'host1'), ('ip', '10.0.0.1')],
+		 [('location', 'mel'), ('vendor_product', 'operating_system_host')]),
+		('2', ['_key', 'identifier', 'informational'], [('host', 'host2')], [('disk_name', 'sda'), ('location', 'syd')])]
+	assert [e['_key'] for e in cfg.session.entities] == ['1', '2']
+	assert cfg.session.entities[1]['title'] == 'HOST2'
+	assert pairs(cfg.session.entities[1]['informational']) == [('disk_name', 'sda'), ('location', 'syd')]
+
+
+def flaky(cfg, fail):
+	"""
+	Make cfg's bulk updates go through fail(n, body) first, n counts the bulk updates from 0, it returns a response
+	or an exception to send instead of the stub's answer, or None to let it through
+	"""
+	real_request = cfg.session.request
+	posts = []
+
+	def request(method, url, data=None, **kwargs):
+		if method == 'POST':
+			posts.append(data)
+			res = fail(len(posts) - 1, data)
+			if isinstance(res, Exception):
+				raise res
+			if res is not None:
+				return res
+		return real_request(method, url, data=data, **kwargs)
+	cfg.session.request = request
+	return posts
+
+
+def test_BulkWriter_retries_a_failed_chunk():
+	cfg = stub_config(many(5))
+	flaky(cfg, lambda n, body: StubResponse({'messages': 'busy'}, 500) if n == 0 else None)
+	res = cfg.bulk_write('entity', [{'_key': '0001', 'title': 'x'}, {'_key': '0002', 'title': 'y'}], backoff=0)
+	assert (res['objects'], res['chunks'], res['retries'], res['failed'], res['error']) == (2, 1, 1, [], None)
+	assert [e['title'] for e in cfg.session.entities[1:3]] == ['x', 'y']
+
+
+def test_BulkWriter_retries_connection_errors():
+	cfg = stub_config(many(5))
+	posts = flaky(cfg, lambda n, body: requests.exceptions.ConnectionError("reset") if n < 2 else None)
+	res = cfg.bulk_write('entity', [{'_key': '0001', 'title': 'x'}], backoff=0)
+	assert (res['objects'], res['retries'], res['failed']) == (1, 2, [])
+	assert len(posts) == 3
+
+
+def test_BulkWriter_gives_up():
+	cfg = stub_config(many(5))
+	posts = flaky(cfg, lambda n, body: StubResponse({'messages': 'bad'}, 400) if b'"0003"' in body else None)
+	objs = [{'_key': k, 'title': 'x'} for k in ('0001', '0002', '0003', '0004')]
+	res = cfg.bulk_write('entity', objs, batch_size=2, retries=2, backoff=0, workers=1)
+	assert (res['objects'], res['chunks'], res['retries']) == (2, 1, 2)
+	(chunk, error), = res['failed']
+	assert [o['_key'] for o in chunk] == ['0003', '0004'] and isinstance(error, ItsiError)
+	assert len(posts) == 4
+
+
+def test_BulkWriter_input_error_keeps_what_was_read():
+	cfg = stub_config(many(5))
+
+	def objects():
+		for k in ('0001', '0002', '0003'):
+			yield {'_key': k, 'title': 'x'}
+		raise ValueError("bad row")
+	res = cfg.bulk_write('entity', objects(), batch_size=2)
+	assert isinstance(res['error'], ValueError)
+	assert (res['objects'], res['chunks'], res['failed']) == (3, 2, [])
+	assert [e['title'] for e in cfg.session.entities] == ['e0', 'x', 'x', 'x', 'e4']
+
+
+def test_BulkWriter_splits_by_bytes():
+	cfg = stub_config(many(20))
+	objs = [{'_key': '%04d' % i, 'title': 'x' * 100} for i in range(20)]
+	size = len(cfg.serializer.dumps(objs[0]))
+	res = cfg.bulk_write('entity', objs, max_bytes=5 * size, batch_size=100, workers=2)
+	posts = [c[3] for c in cfg.session.calls if c[0] == 'POST']
+	assert res['objects'] == 20 and res['chunks'] == len(posts)
+	assert all(len(cfg.serializer.dumps(p)) <= 5 * size for p in posts)
+	assert [len(p) for p in posts] == [4] * 5
+	assert sorted(o['_key'] for p in posts for o in p) == ['%04d' % i for i in range(20)]
+	# one object bigger than max_bytes still goes, on its own
+	res = cfg.bulk_write('entity', objs[:3], max_bytes=10, workers=1)
+	assert res['chunks'] == 3 and res['failed'] == []
+
+
+def test_BulkWriter_waits_for_the_refresh_queue():
+	cfg = stub_config(many(5))
+	real_request = cfg.session.request
+	sizes = [3, 2, 0]
+	order = []
+
+	def request(method, url, **kwargs):
+		if 'itsi_refresh_queue' in url:
+			order.append('q')
+			return StubResponse([{}] * sizes.pop(0))
+		order.append(method)
+		return real_request(method, url, **kwargs)
+	cfg.session.request = request
+	res = cfg.bulk_write('entity', [{'_key': '0001', 'title': 'x'}], max_refresh_q=1, q_check_secs=0.01)
+	assert res['objects'] == 1
+	assert order == ['q', 'q', 'q', 'POST']
+	# max_refresh_q=0 doesn't look at it
+	order[:] = []
+	cfg.bulk_write('entity', [{'_key': '0001', 'title': 'x'}], max_refresh_q=0)
+	assert order == ['POST']
+
+
+def test_SyncStore(tmpdir):
+	objs = [dict(entity(k, 't' + k), mod_time=1, description='d') for k in ('1', '2', '3', '4', '5')]
+	cfg = stub_config(objs)
+	store = itsi.SyncStore(str(tmpdir.join('sync.db')))
+	fields = '_key,title,identifier'
+
+	res = store.sync(cfg, 'entity', fields=fields)
+	assert sorted(o['_key'] for o in res.added) == ['1', '2', '3', '4', '5']
+	assert (res.changed, res.deleted, res.touched) == ([], [], [])
+	assert all(sorted(o) == ['_key', 'identifier', 'mod_time', 'title'] for o in res.added)
+
+	es = dict((e['_key'], e) for e in cfg.session.entities)
+	# 1 has changed, 2 was saved without changing and only a field that isn't tracked has changed on 4
+	es['1'].update(title='new', mod_time=2)
+	es['2'].update(mod_time=2)
+	es['4'].update(description='d2', mod_time=2)
+	cfg.session.entities.remove(es['3'])
+	cfg.session.entities.append(dict(entity('6', 't6'), mod_time=1))
+
+	res = store.sync(cfg, 'entity', fields=fields, commit=False)
+	assert [o['_key'] for o in res.added] == ['6']
+	assert [(o['_key'], o['title']) for o in res.changed] == [('1', 'new')]
+	assert res.deleted == ['3']
+	assert sorted(o['_key'] for o in res.touched) == ['2', '4']
+	# only what changed is fetched again, 5 hasn't moved
+	fetched = [c[2]['filter'][0] for c in cfg.session.calls if 'filter' in c[2]]
+	assert sorted(json.loads(fetched[-1])['_key']['$in']) == ['1', '2', '4', '6']
+
+	# nothing was saved so the same changes come back until they are committed
+	again = store.sync(cfg, 'entity', fields=fields, commit=False)
+	assert ([o['_key'] for o in again.added], again.deleted) == (['6'], ['3'])
+	store.commit('entity', res)
+	res = store.sync(cfg, 'entity', fields=fields)
+	assert res == ([], [], [], [])
+
+	# each snapshot has its own state
+	res = store.sync(cfg, 'entity', fields=fields, name='other', workers=2, chunk=2)
+	assert sorted(o['_key'] for o in res.added) == ['1', '2', '4', '5', '6']
+	store.reset('entity')
+	assert len(store.sync(cfg, 'entity', fields=fields).added) == 5
+	store.close()
+
+
+def test_TrackedObject_sends_only_changes():
+	cfg = stub_config(ENTITIES + many(4))
+	objs = cfg.read_config('entity', fields='_key,title,identifier,informational', track=True, page_size=3)
+	assert len(objs) == 7 and all(isinstance(o, itsi.TrackedObject) for o in objs)
+	assert not any(o.is_dirty() for o in objs)
+	by_key = dict((o['_key'], o) for o in objs)
+	by_key['1']['title'] = 'renamed'
+	by_key['2']['identifier']['values'][0] = 'host2.example.com'
+	by_key['3']['description'] = 'new'
+	assert by_key['2'].dirty_fields() == set(['identifier'])
+
+	res = cfg.bulk_write('entity', objs)
+	assert (res['objects'], res['skipped']) == (3, 4)
+	(method, path, query, body), = [c for c in cfg.session.calls if c[0] == 'POST']
+	assert query['is_partial_data'] == ['1']
+	assert sorted(body, key=lambda o: o['_key']) == [
+		{'_key': '1', 'title': 'renamed'},
+		{'_key': '2', 'identifier': {'fields': ['host', 'disk_name'], 'values': ['host2.example.com', 'sda']}},
+		{'_key': '3', 'description': 'new'}]
+
+	# nothing is sent once they are marked clean, a full write sends everything
+	for o in objs:
+		o.mark_clean()
+	assert all(o.changes() is None for o in objs)
+	res = cfg.bulk_write('entity', objs)
+	assert (res['objects'], res['skipped'], res['chunks']) == (0, 7, 0)
+	res = cfg.bulk_write('entity', objs, partial=False)
+	assert (res['objects'], res['skipped']) == (7, 0)
+	body = [c for c in cfg.session.calls if c[0] == 'POST'][-1][3]
+	assert sorted(body[0]) == ['_key', 'identifier', 'informational', 'title']